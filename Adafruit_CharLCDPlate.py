@@ -9,8 +9,23 @@
 # LiquidCrystal - https://github.com/arduino/Arduino/blob/master/libraries/LiquidCrystal/LiquidCrystal.cpp
 
 from Adafruit_I2C import Adafruit_I2C
+from clock import monotonic
+from contextlib import contextmanager
 from time import sleep
 
+
+# PORTB states over time for writing every byte value to the LCD
+# with the given control bits, 4 characters per value (see out4)
+def _strobes(flip, bitmask):
+    table = []
+    for value in range(256):
+        hi = bitmask | flip[value >> 4]
+        lo = bitmask | flip[value & 0x0F]
+        table.append(''.join(map(chr, (hi | 0b00100000, hi,
+                                       lo | 0b00100000, lo))))
+    return table
+
+
 class Adafruit_CharLCDPlate(Adafruit_I2C):
 
     # ----------------------------------------------------------------------
@@ -20,6 +35,9 @@ class Adafruit_CharLCDPlate(Adafruit_I2C):
     MCP23017_IOCON_BANK0    = 0x0A  # IOCON when Bank 0 active
     MCP23017_IOCON_BANK1    = 0x15  # IOCON when Bank 1 active
     # These are register addresses when in Bank 1 only:
+    MCP23017_GPINTENA       = 0x02
+    MCP23017_INTFA          = 0x07
+    MCP23017_INTCAPA        = 0x08
     MCP23017_GPIOA          = 0x09
     MCP23017_IODIRB         = 0x10
     MCP23017_GPIOB          = 0x19
@@ -30,6 +48,8 @@ class Adafruit_CharLCDPlate(Adafruit_I2C):
     DOWN                    = 2
     UP                      = 3
     LEFT                    = 4
+    BUTTONS                 = 0b00011111
+    SPARE                   = 5  # the free port A pin, e.g. for a backlight
 
     # LED colors
     OFF                     = 0x00
@@ -72,17 +92,55 @@ class Adafruit_CharLCDPlate(Adafruit_I2C):
     LCD_MOVERIGHT   = 0x04
     LCD_MOVELEFT    = 0x00
 
+    # Characters of display RAM per line, the display shift wraps here
+    DDRAM_WIDTH     = 40
+
 
     # ----------------------------------------------------------------------
     # Constructor
 
-    def __init__(self, busnum=-1, addr=0x20, debug=False):
-
-        self.i2c = Adafruit_I2C(addr, busnum, debug)
+    # interrupt is optional: an object with a wait(timeout) method that
+    # returns True when the MCP23017 INT line is asserted (e.g. a
+    # gpiochip.LineEvent).  Given one, interrupt-on-change is enabled
+    # for the buttons and waitButtons() can be used instead of polling.
+    # timing is how slow instructions are waited for, 'poll' (the LCD
+    # busy flag) or 'deadline' (the datasheet time, see write()).
+    # bus replaces the smbus.SMBus, e.g. by a fakebus.FakeSMBus.
+    # backlight is the port A pin of a backlight of its own (SPARE, made
+    # an output, active high), set_backlight() switches it instead of
+    # the RGB LEDs.  initial_color is the (red, green, blue) of the LEDs
+    # to start with, as set_color() takes it.
+    def __init__(self, busnum=-1, addr=0x20, debug=False, interrupt=None,
+                 timing='poll', bus=None, backlight=None, initial_color=(1, 1, 1)):
+
+        self.i2c = Adafruit_I2C(addr, busnum, debug, bus)
+        self.interrupt = interrupt
+        self.timing = timing
+
+        # Busy flag polls done, and slow instructions waited for by the
+        # clock instead (each poll costs at least five I2C transfers)
+        self.polls = 0
+        self.polls_avoided = 0
+        self.busy_until = 0
+
+        # GPIOB bytes not yet sent, see batch()
+        self.pending  = bytearray()
+        self.batching = 0
+        gpinten = self.BUTTONS if interrupt else 0
 
         # I2C is relatively slow.  MCP output port states are cached
         # so we don't need to constantly poll-and-change bit states.
         self.porta, self.portb, self.ddrb = 0, 0, 0b00010000
+        self.ddra = 0b00111111
+        if timing == 'deadline':
+            self.ddrb = 0
+        self.backlightpin = backlight
+        if backlight is not None:
+            self.ddra &= ~(1 << backlight)
+        self.color = self.rgb(*initial_color)
+        c          = ~self.color
+        self.porta = (c & 0b011) << 6
+        self.portb = (c & 0b100) >> 2
 
         # Set MCP23017 IOCON register to Bank 0 with sequential operation.
         # If chip is already set for Bank 0, this will just write to OLATB,
@@ -96,15 +154,15 @@ class Adafruit_CharLCDPlate(Adafruit_I2C):
         # sets up all the input pins, pull-ups, etc. for the Pi Plate.
         self.i2c.bus.write_i2c_block_data(
           self.i2c.address, 0, 
-          [ 0b00111111,   # IODIRA    R+G LEDs=outputs, buttons=inputs
+          [ self.ddra ,   # IODIRA    R+G LEDs=outputs, buttons=inputs
             self.ddrb ,   # IODIRB    LCD D7=input, Blue LED=output
             0b00111111,   # IPOLA     Invert polarity on button inputs
             0b00000000,   # IPOLB
-            0b00000000,   # GPINTENA  Disable interrupt-on-change
+            gpinten   ,   # GPINTENA  Interrupt-on-change for buttons if used
             0b00000000,   # GPINTENB
             0b00000000,   # DEFVALA
             0b00000000,   # DEFVALB
-            0b00000000,   # INTCONA
+            0b00000000,   # INTCONA   Compare against previous pin value
             0b00000000,   # INTCONB
             0b00000000,   # IOCON
             0b00000000,   # IOCON
@@ -116,8 +174,8 @@ class Adafruit_CharLCDPlate(Adafruit_I2C):
             0b00000000,   # INTCAPB
             self.porta,   # GPIOA
             self.portb,   # GPIOB
-            self.porta,   # OLATA     0 on all outputs; side effect of
-            self.portb ]) # OLATB     turning on R+G+B backlight LEDs.
+            self.porta,   # OLATA     LEDs as initial_color, backlight
+            self.portb ]) # OLATB     pin off (if there is one)
 
         # Switch to Bank 1 and disable sequential operation.
         # From this point forward, the register addresses do NOT match
@@ -125,8 +183,13 @@ class Adafruit_CharLCDPlate(Adafruit_I2C):
         # at the start of the class.  Also, the address register will no
         # longer increment automatically after this -- multi-byte
         # operations must be broken down into single-byte calls.
+        # With interrupts INTA/INTB are mirrored, so either pin works.
         self.i2c.bus.write_byte_data(
-          self.i2c.address, self.MCP23017_IOCON_BANK0, 0b10100000)
+          self.i2c.address, self.MCP23017_IOCON_BANK0,
+          0b11100000 if interrupt else 0b10100000)
+        if interrupt:
+            # Clear anything captured while configuring
+            self.i2c.readU8(self.MCP23017_INTCAPA)
 
         self.displayshift   = (self.LCD_CURSORMOVE |
                                self.LCD_MOVERIGHT)
@@ -136,6 +199,13 @@ class Adafruit_CharLCDPlate(Adafruit_I2C):
                                self.LCD_CURSOROFF |
                                self.LCD_BLINKOFF)
 
+        # Shadow copy of the display RAM, None where unknown, the LCD
+        # address counter (None if unknown or pointing into CGRAM) and the
+        # display shift.  frame() uses them to send only what changed.
+        self.shadow = [None] * 0x80
+        self.addr   = None
+        self.shift  = 0
+
         self.write(0x33) # Init
         self.write(0x32) # Init
         self.write(0x28) # 2 line 5x8 matrix
@@ -167,6 +237,13 @@ class Adafruit_CharLCDPlate(Adafruit_I2C):
         lo = bitmask | self.flip[value & 0x0F]
         return [hi | 0b00100000, hi, lo | 0b00100000, lo]
 
+    # out4 precomputed for all byte values, indexed by the control bits
+    # (blue LED bit, data bit).  write() joins these into whole transfers.
+    strobes = {}
+    for _bitmask in (0b00000000, 0b00000001, 0b10000000, 0b10000001):
+        strobes[_bitmask] = _strobes(flip, _bitmask)
+    del _bitmask
+
 
     # The speed of LCD accesses is inherently limited by I2C through the
     # port expander.  A 'well behaved program' is expected to poll the
@@ -182,12 +259,21 @@ class Adafruit_CharLCDPlate(Adafruit_I2C):
 
     pollables = ( LCD_CLEARDISPLAY, LCD_RETURNHOME )
 
+    # Instead of polling, the 'deadline' timing notes when a pollable
+    # instruction was sent and, if more is sent before its execution time
+    # has passed, sleeps for the rest.  1.52 ms per the datasheet, with
+    # margin for a slow LCD oscillator.  Usually the time has passed by
+    # then and nothing is waited for at all.
+    LCD_SLOWTIME = 0.002
+
     # Write byte, list or string value to LCD
     def write(self, value, char_mode=False):
         """ Send command/data to LCD """
 
         # If pin D7 is in input state, poll LCD busy flag until clear.
         if self.ddrb & 0b00010000:
+            self.flush()
+            self.polls += 1
             lo = (self.portb & 0b00000001) | 0b01000000
             hi = lo | 0b00100000 # E=1 (strobe)
             self.i2c.bus.write_byte_data(
@@ -210,48 +296,117 @@ class Adafruit_CharLCDPlate(Adafruit_I2C):
 
         bitmask = self.portb & 0b00000001   # Mask out PORTB LCD control bits
         if char_mode: bitmask |= 0b10000000 # Set data bit if not a command
+        table = self.strobes[bitmask]
 
-        # If string or list, iterate through multiple write ops
+        # Join the 4 byte PORTB sequences of all bytes at once.  First the
+        # high 4 data bits with strobe (enable) set and unset, then same
+        # with low 4 data bits (strobe 1/0).
         if isinstance(value, str):
-            last = len(value) - 1 # Last character in string
-            data = []             # Start with blank list
-            for i, v in enumerate(value): # For each character...
-                # Append 4 bytes to list representing PORTB over time.
-                # First the high 4 data bits with strobe (enable) set
-                # and unset, then same with low 4 data bits (strobe 1/0).
-                data.extend(self.out4(bitmask, ord(v)))
-                # I2C block data write is limited to 32 bytes max.
-                # If limit reached, write data so far and clear.
-                # Also do this on last byte if not otherwise handled.
-                if (len(data) >= 32) or (i == last):
-                    self.i2c.bus.write_i2c_block_data(
-                      self.i2c.address, self.MCP23017_GPIOB, data)
-                    self.portb = data[-1] # Save state of last byte out
-                    data       = []       # Clear list for next iteration
+            data = bytearray(''.join([table[v] for v in bytearray(value)]))
         elif isinstance(value, list):
-            # Same as above, but for list instead of string
-            last = len(value) - 1
-            data = []
-            for i, v in enumerate(value):
-                data.extend(self.out4(bitmask, v))
-                if (len(data) >= 32) or (i == last):
-                    self.i2c.bus.write_i2c_block_data(
-                      self.i2c.address, self.MCP23017_GPIOB, data)
-                    self.portb = data[-1]
-                    data       = []
+            data = bytearray(''.join([table[v] for v in value]))
         else:
-            # Single byte
-            data = self.out4(bitmask, value)
-            self.i2c.bus.write_i2c_block_data(
-              self.i2c.address, self.MCP23017_GPIOB, data)
-            self.portb = data[-1]
+            data = bytearray(table[value])
+
+        self.pending += data
+        if data:
+            self.portb = data[-1] # Save state of last byte out
 
         # If a poll-worthy instruction was issued, reconfigure D7
         # pin as input to indicate need for polling on next call.
         if (not char_mode) and (value in self.pollables):
-            self.ddrb |= 0b00010000
-            self.i2c.bus.write_byte_data(self.i2c.address,
-              self.MCP23017_IODIRB, self.ddrb)
+            self.flush()
+            if self.timing == 'deadline':
+                self.busy_until = monotonic() + self.LCD_SLOWTIME
+                self.polls_avoided += 1
+            else:
+                self.ddrb |= 0b00010000
+                self.i2c.bus.write_byte_data(self.i2c.address,
+                  self.MCP23017_IODIRB, self.ddrb)
+        elif not self.batching:
+            self.flush()
+
+        self.track(value, char_mode)
+
+
+    # Send the queued GPIOB bytes.  I2C block data write is limited to
+    # 32 bytes max.
+    def flush(self):
+        data, self.pending = self.pending, bytearray()
+        if data and self.busy_until:
+            # Never more than LCD_SLOWTIME, should the clock jump
+            left = self.busy_until - monotonic()
+            if left > 0:
+                sleep(min(left, self.LCD_SLOWTIME))
+            self.busy_until = 0
+        for i in range(0, len(data), 32):
+            self.i2c.bus.write_i2c_block_data(
+              self.i2c.address, self.MCP23017_GPIOB, list(data[i:i + 32]))
+
+
+    # Within 'with lcd.batch():' the PORTB sequences of all commands,
+    # data and backlight changes are queued and sent in as few full
+    # 32 byte transfers as possible when the outermost batch ends.  Only
+    # a poll-worthy instruction flushes early, as the busy flag has to
+    # be polled before anything else is sent.
+    @contextmanager
+    def batch(self):
+        self.batching += 1
+        try:
+            yield self
+        finally:
+            self.batching -= 1
+            if not self.batching:
+                self.flush()
+
+
+    # Follow what a write does to the display RAM and address counter.
+    # Only the default left to right entry mode without display shift
+    # is followed, anything else forgets the shadow contents.
+    def track(self, value, char_mode):
+        if isinstance(value, str):
+            value = bytearray(value)
+        elif not isinstance(value, list):
+            value = [value]
+        if char_mode:
+            if self.addr is None:
+                return
+            if self.displaymode != self.LCD_ENTRYLEFT:
+                self.shadow = [None] * 0x80
+                self.addr   = None
+                return
+            addr = self.addr
+            # Line 1 ends at 0x27 and continues at 0x40, and back
+            end = (addr & 0x40) + self.DDRAM_WIDTH
+            if addr + len(value) < end:
+                self.shadow[addr:addr + len(value)] = value
+                self.addr = addr + len(value)
+                return
+            for v in value:
+                self.shadow[addr] = v
+                addr = 0x40 if addr == 0x27 else 0x00 if addr == 0x67 else addr + 1
+            self.addr = addr
+            return
+        for v in value:
+            if v & self.LCD_SETDDRAMADDR:
+                self.addr = v & 0x7F
+            elif v & self.LCD_SETCGRAMADDR:
+                self.addr = None
+            elif v & self.LCD_FUNCTIONSET:
+                pass
+            elif v & self.LCD_CURSORSHIFT:
+                if v & self.LCD_DISPLAYMOVE:
+                    step = 1 if v & self.LCD_MOVERIGHT else -1
+                    self.shift = (self.shift - step) % self.DDRAM_WIDTH
+                else:
+                    self.addr = None
+            elif v == self.LCD_CLEARDISPLAY:
+                self.shadow = [0x20] * 0x80
+                self.addr   = 0
+                self.shift  = 0
+            elif v == self.LCD_RETURNHOME:
+                self.addr   = 0
+                self.shift  = 0
 
 
     # ----------------------------------------------------------------------
@@ -268,6 +423,7 @@ class Adafruit_CharLCDPlate(Adafruit_I2C):
     # Any code using this newer version of the library should
     # consider adding an atexit() handler that calls this.
     def stop(self):
+        self.flush()
         self.porta = 0b11000000  # Turn off LEDs on the way out
         self.portb = 0b00000001
         sleep(0.0015)
@@ -374,6 +530,23 @@ class Adafruit_CharLCDPlate(Adafruit_I2C):
         self.write(self.LCD_CURSORSHIFT | self.displayshift)
 
 
+    def scrollTo(self, shift):
+        """ Shift the display so column shift of the RAM is leftmost """
+        steps = (shift - self.shift) % self.DDRAM_WIDTH
+        if not steps:
+            return
+        if not shift:
+            self.home()
+            return
+        with self.batch():
+            if steps <= self.DDRAM_WIDTH // 2:
+                for i in range(steps):
+                    self.scrollDisplayLeft()
+            else:
+                for i in range(self.DDRAM_WIDTH - steps):
+                    self.scrollDisplayRight()
+
+
     def leftToRight(self):
         """ This is for text that flows left to right """
         self.displaymode |= self.LCD_ENTRYLEFT
@@ -404,13 +577,58 @@ class Adafruit_CharLCDPlate(Adafruit_I2C):
         self.write(self.LCD_SETDDRAMADDR)
 
 
+    # Show a list of lines, one string per row, starting at the first
+    # visible column (the display may be shifted).  Unlike message() only
+    # the runs of characters that differ from the shadow display RAM are
+    # sent, each after a DDRAM address command.  Runs separated by a
+    # single unchanged character are merged, since rewriting it costs as
+    # much as another address command.  Lines may be longer than the
+    # display, up to DDRAM_WIDTH characters are kept in display RAM and
+    # can be scrolled into view with scrollDisplayLeft().
+    # If shift is given the display is shifted there first (see scrollTo)
+    def frame(self, lines, shift=None):
+        with self.batch():
+            if shift is not None:
+                self.scrollTo(shift)
+            self._frame(lines)
+
+    def _frame(self, lines):
+        width = self.DDRAM_WIDTH
+        for row, line in enumerate(lines[:len(self.row_offsets)]):
+            line = line[:width]
+            base = self.row_offsets[row]
+            first = start = end = None
+            for col, c in enumerate(line):
+                pos = (self.shift + col) % width
+                if start is not None and (col - end > 2 or pos == 0):
+                    self.writeAt(base + first, line[start:end + 1])
+                    start = None
+                if self.shadow[base + pos] == ord(c):
+                    continue
+                if start is None:
+                    first = pos
+                    start = col
+                end = col
+            if start is not None:
+                self.writeAt(base + first, line[start:end + 1])
+
+
+    # Write text at a DDRAM address, skipping the address command if the
+    # address counter is already there
+    def writeAt(self, addr, text):
+        if self.addr != addr:
+            self.write(self.LCD_SETDDRAMADDR | addr)
+        self.write(text, True)
+
+
     def message(self, text):
         """ Send string to LCD. Newline wraps to second line"""
         lines = str(text).split('\n')    # Split at newline(s)
-        for i, line in enumerate(lines): # For each substring...
-            if i > 0:                    # If newline(s),
-                self.write(0xC0)         #  set DDRAM address to 2nd line
-            self.write(line, True)       # Issue substring
+        with self.batch():
+            for i, line in enumerate(lines): # For each substring...
+                if i > 0:                    # If newline(s),
+                    self.write(0xC0)         #  set DDRAM address to 2nd line
+                self.write(line, True)       # Issue substring
 
 
     def backlight(self, color):
@@ -418,24 +636,121 @@ class Adafruit_CharLCDPlate(Adafruit_I2C):
         self.porta = (self.porta & 0b00111111) | ((c & 0b011) << 6)
         self.portb = (self.portb & 0b11111110) | ((c & 0b100) >> 2)
         # Has to be done as two writes because sequential operation is off.
+        # The GPIOB one goes with the LCD data when in a batch.
         self.i2c.bus.write_byte_data(
           self.i2c.address, self.MCP23017_GPIOA, self.porta)
+        self.pending.append(self.portb)
+        if not self.batching:
+            self.flush()
+
+
+    # Backlight and display calls of the newer Adafruit_CharLCD library, so this
+    # driver can stand in for it.  The LEDs are only on or off.
+    def rgb(self, red, green, blue):
+        return ((self.RED if red > 0.5 else 0) |
+                (self.GREEN if green > 0.5 else 0) |
+                (self.BLUE if blue > 0.5 else 0))
+
+
+    def set_color(self, red, green, blue):
+        self.color = self.rgb(red, green, blue)
+        self.backlight(self.color)
+
+
+    # The backlight pin if there is one, else the LEDs in their color
+    def set_backlight(self, backlight):
+        if self.backlightpin is None:
+            self.backlight(self.color if backlight else self.OFF)
+            return
+        mask = 1 << self.backlightpin
+        self.porta = (self.porta | mask) if backlight else (self.porta & ~mask)
         self.i2c.bus.write_byte_data(
-          self.i2c.address, self.MCP23017_GPIOB, self.portb)
+          self.i2c.address, self.MCP23017_GPIOA, self.porta)
+
+
+    def enable_display(self, enable):
+        if enable:
+            self.display()
+        else:
+            self.noDisplay()
+
+
+    # Read a button register.  readU8 returns -1 for a failed transfer,
+    # which masked would be all buttons pressed: raise IOError instead.
+    def readButtons(self, reg):
+        value = self.i2c.readU8(reg)
+        if value < 0:
+            raise IOError('reading the buttons (register 0x%02X) failed' % reg)
+        return value & self.BUTTONS
 
 
     # Read state of single button
     def buttonPressed(self, b):
-        return (self.i2c.readU8(self.MCP23017_GPIOA) >> b) & 1
+        return (self.readButtons(self.MCP23017_GPIOA) >> b) & 1
 
 
     # Read and return bitmask of combined button state
     def buttons(self):
-        return self.i2c.readU8(self.MCP23017_GPIOA) & 0b11111
+        return self.readButtons(self.MCP23017_GPIOA)
 
 
-    # ----------------------------------------------------------------------
-    # Test code
+    # State of the given buttons as a list of booleans
+    # (same as read_buttons of the newer Adafruit_CharLCD library)
+    def read_buttons(self, buttons):
+        state = self.buttons()
+        return [bool((state >> b) & 1) for b in buttons]
+
+
+    # After an interrupt: return the button bitmasks captured at the
+    # interrupt and, if different, the current one.  A press shorter than
+    # the time to get here is seen as a press followed by a release.
+    # Reading INTCAP clears the interrupt.
+    def readInterrupt(self):
+        cap = self.readButtons(self.MCP23017_INTCAPA)
+        now = self.buttons()
+        return [cap] if cap == now else [cap, now]
+
+
+    # Without an interrupt line: have the port expander latch button
+    # changes (interrupt-on-change, only the INT pin is not wired), so
+    # readLatched() can be called seldom and still see a short press.
+    def latch(self, enable):
+        if self.interrupt:
+            return
+        self.i2c.bus.write_byte_data(
+          self.i2c.address, self.MCP23017_GPINTENA, self.BUTTONS if enable else 0)
+        if enable:
+            # Clear anything captured before
+            self.i2c.readU8(self.MCP23017_INTCAPA)
+
+
+    # With latch() on: the button bitmasks of readInterrupt() if a button
+    # changed since the last call, else [] (one register read)
+    def readLatched(self):
+        if not self.readButtons(self.MCP23017_INTFA):
+            return []
+        return self.readInterrupt()
+
+
+    # Wait up to timeout seconds for a button change without touching
+    # the bus, return the button bitmasks seen or [] if nothing changed
+    def waitButtons(self, timeout=None):
+        if not self.interrupt.wait(timeout):
+            return []
+        return self.readInterrupt()
+
+
+# Button pins at module level, as Adafruit_CharLCD has them
+SELECT = Adafruit_CharLCDPlate.SELECT
+RIGHT  = Adafruit_CharLCDPlate.RIGHT
+DOWN   = Adafruit_CharLCDPlate.DOWN
+UP     = Adafruit_CharLCDPlate.UP
+LEFT   = Adafruit_CharLCDPlate.LEFT
+LCD_PLATE_SPARE = Adafruit_CharLCDPlate.SPARE
+
+
+# ----------------------------------------------------------------------
+# Test code
 
 if __name__ == '__main__':
 
@@ -1,12 +1,16 @@
 #!/usr/bin/python
 
-import smbus
+try:
+  import smbus
+except ImportError:
+  # only needed for a real bus, see the bus argument below
+  smbus = None
 
 # ===========================================================================
 # Adafruit_I2C Class
 # ===========================================================================
 
-class Adafruit_I2C :
+class Adafruit_I2C(object):
 
   @staticmethod
   def getPiRevision():
@@ -26,14 +30,19 @@ class Adafruit_I2C :
     # Gets the I2C bus number /dev/i2c#
     return 1 if Adafruit_I2C.getPiRevision() > 1 else 0
  
-  def __init__(self, address, busnum=-1, debug=False):
+  def __init__(self, address, busnum=-1, debug=False, bus=None):
     self.address = address
     # By default, the correct I2C bus is auto-detected using /proc/cpuinfo
     # Alternatively, you can hard-code the bus version below:
     # self.bus = smbus.SMBus(0); # Force I2C0 (early 256MB Pi's)
     # self.bus = smbus.SMBus(1); # Force I2C1 (512MB Pi's)
-    self.bus = smbus.SMBus(
-      busnum if busnum >= 0 else Adafruit_I2C.getPiI2CBusNumber())
+    # or pass any object with the smbus methods as bus (e.g. fakebus.FakeSMBus)
+    if bus is None:
+      if smbus is None:
+        raise ImportError("No module named smbus")
+      bus = smbus.SMBus(
+        busnum if busnum >= 0 else Adafruit_I2C.getPiI2CBusNumber())
+    self.bus = bus
     self.debug = debug
 
   def reverseByteOrder(self, data):
@@ -42,11 +42,11 @@ class Adafruit_MCP230XX(Adafruit_I2C):
     MCP23008_OLAT   = 0x0A
 
 
-    def __init__(self, address, num_gpios=8, busnum=-1, debug=False):
+    def __init__(self, address, num_gpios=8, busnum=-1, debug=False, bus=None):
 
         assert 0 < num_gpios < 17, "Number of GPIOs must be between 1 and 16"
 
-        self.i2c       = Adafruit_I2C(address, busnum, debug)
+        self.i2c       = Adafruit_I2C(address, busnum, debug, bus)
         self.num_gpios = num_gpios
         self.pullups   = 0
 
@@ -0,0 +1,260 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: ts=2 sts=2 sw=2 et si
+#
+# Benchmark of the radio UI without hardware
+# by sdb
+#
+# Runs the Radio on the bundled LCD driver over an emulated I2C bus
+# (fakebus) and the fake mpd server (fakempd), presses buttons from a script and measures
+#   - boot: time to the first frame and until the buttons are read
+#   - key to frame latency: from a press on the bus until the next frame
+#     is on the LCD (for the long left that leaves a station: from when
+#     the press became long)
+#   - I2C bytes per frame and per second
+#   - mpd round trips per minute of playback
+#   - CPU seconds per hour of idle playback, the emulation included
+# The results are written as JSON, to compare between releases:
+#
+#   python bench.py -o bench.json
+#
+# Open source. MIT license
+
+
+import argparse
+import json
+import math
+import os
+import sys
+import threading
+from collections import defaultdict
+from time import sleep
+
+import fakebus
+import fakempd
+import keypad
+import mpdclient
+import radio
+from Adafruit_CharLCDPlate import Adafruit_CharLCDPlate
+from clock import monotonic
+
+
+DEBUG = 0
+HOLD = 0.15    # seconds a button is held
+LONG = keypad.LONG_SECS + 0.3   # held for the phases in LONGS
+PAUSE = 0.5    # seconds between presses
+WAIT = 2.0     # seconds to wait for a frame after a press
+
+# (phase, button) pressed one after another
+SCRIPT = (
+  [('menu', radio.LCD.RIGHT)] +
+  [('menu', radio.LCD.DOWN)] * 5 +
+  [('menu', radio.LCD.UP)] * 2 +
+  [('start', radio.LCD.RIGHT)] +
+  [('playlist', b) for b in (radio.LCD.UP, radio.LCD.UP, radio.LCD.DOWN, radio.LCD.SELECT, radio.LCD.SELECT)] +
+  [('zap', b) for b in (radio.LCD.RIGHT, radio.LCD.RIGHT, radio.LCD.LEFT, radio.LCD.RIGHT)] +
+  [('idle', None)] +
+  [('exit', radio.LCD.LEFT)] +
+  [('menu', b) for b in (radio.LCD.LEFT, radio.LCD.DOWN, radio.LCD.RIGHT, radio.LCD.DOWN, radio.LCD.DOWN, radio.LCD.LEFT)]
+)
+LONGS = ('exit',)
+
+
+
+
+def percentile(values, p):
+  'Nearest rank percentile, None without values'
+  if not values:
+    return None
+  values = sorted(values)
+  return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+def cputime():
+  'user + system seconds of this process, all threads'
+  t = os.times()
+  return t[0] + t[1]
+
+
+
+
+class Plate(Adafruit_CharLCDPlate):
+  ''' The LCD driver with the frames it draws timed and their I2C bytes counted '''
+
+  def __init__(self, bus, **kwargs):
+    self.frames = []
+    self.cond = threading.Condition()
+    super(Plate, self).__init__(bus=bus, **kwargs)
+
+  def frame(self, lines, shift=None):
+    bus = self.i2c.bus
+    before = sum(bus.bytes.values())
+    super(Plate, self).frame(lines, shift)
+    with self.cond:
+      self.frames.append((monotonic(), sum(bus.bytes.values()) - before))
+      self.cond.notify_all()
+
+  def wait_frame(self, index, timeout):
+    'The time of frame number index, None if not drawn within timeout'
+    deadline = monotonic() + timeout
+    with self.cond:
+      while len(self.frames) <= index:
+        left = deadline - monotonic()
+        if left <= 0:
+          return None
+        self.cond.wait(left)
+      return self.frames[index][0]
+
+
+
+
+class Bench(object):
+  ''' Runs the Radio on the fakes and the script against it '''
+
+  def __init__(self, args):
+    self.args = args
+    self.bus = fakebus.FakePlate(latency=args.latency)
+    radio.STARTED = monotonic()   # boot from the LCD init on, like radio.py
+    self.lcd = Plate(self.bus, timing=args.timing,
+      interrupt=self.bus.int if args.interrupt else None)
+    self.mpd = fakempd.FakeMPDServer(delay=args.mpd_delay).start()
+    self.player = self.mpd.player
+    self.radio = radio.Radio(lcd=self.lcd, mpd=mpdclient.MPDClient(*self.mpd.address))
+    self.latencies = defaultdict(list)
+    self.missed = defaultdict(int)  # presses that changed nothing on screen
+    self.idle = {}
+
+  def press(self, phase, button):
+    'Press and release a button, note the time to the next frame'
+    hold = HOLD
+    self.bus.press(button)
+    if phase in LONGS:
+      # from when it is long
+      sleep(keypad.LONG_SECS)
+      hold = LONG - keypad.LONG_SECS
+    with self.lcd.cond:
+      index = len(self.lcd.frames)
+    start = monotonic()
+    drawn = self.lcd.wait_frame(index, hold)
+    self.bus.release(button)
+    if drawn is None:
+      drawn = self.lcd.wait_frame(index, start + WAIT - monotonic())
+    if drawn is None:
+      self.missed[phase] += 1
+    else:
+      self.latencies[phase].append(drawn - start)
+    if DEBUG: print phase, button, drawn and '%.1f ms' % ((drawn - start) * 1e3)
+    sleep(PAUSE)
+
+  def playback(self, seconds):
+    'Idle playback with new stream titles every now and then'
+    frames, i2c = len(self.lcd.frames), sum(self.bus.bytes.values())
+    roundtrips = dict(self.player.calls)
+    titles = self.player.titles
+    cpu, start = cputime(), monotonic()
+    while True:
+      left = seconds - (monotonic() - start)
+      if left <= 0:
+        break
+      sleep(min(self.args.meta, left))
+      if left > self.args.meta:
+        self.player.retitle()
+    cpu, elapsed = cputime() - cpu, monotonic() - start
+    calls = dict((k, v - roundtrips.get(k, 0)) for k, v in self.player.calls.items()
+                 if v != roundtrips.get(k, 0))
+    self.idle = {
+      'seconds': elapsed,
+      'titles': self.player.titles - titles,
+      'frames': len(self.lcd.frames) - frames,
+      'i2c_bytes_per_second': (sum(self.bus.bytes.values()) - i2c) / elapsed,
+      'mpd_round_trips_per_minute': sum(calls.values()) * 60 / elapsed,
+      'mpd_round_trips': calls,
+      'cpu_seconds_per_hour': cpu * 3600 / elapsed,
+    }
+
+  def script(self):
+    try:
+      sleep(1)
+      for phase, button in SCRIPT:
+        if button is None:
+          self.playback(self.args.idle)
+        else:
+          self.press(phase, button)
+    finally:
+      self.radio.loop.call_soon(self._stop)
+
+  def _stop(self):
+    raise SystemExit('bench done')
+
+  def run(self):
+    script = threading.Thread(target=self.script, name='script')
+    script.daemon = True
+    script.start()
+    self.radio.run()
+    script.join()
+    self.mpd.stop()
+    return self.results()
+
+  def results(self):
+    latency = {}
+    every = []
+    for phase in sorted(set(p for p, b in SCRIPT if b is not None)):
+      values = self.latencies[phase]
+      every += values
+      latency[phase] = self._stats(values, self.missed[phase])
+    latency['all'] = self._stats(every, sum(self.missed.values()))
+    frames = [n for t, n in self.lcd.frames]
+    return {
+      'config': {
+        'timing': self.args.timing,
+        'interrupt': self.args.interrupt,
+        'latency': self.args.latency,
+        'mpd_delay': self.args.mpd_delay,
+        'bitrate': self.bus.bitrate,
+      },
+      'key_to_frame_ms': latency,
+      'boot_ms': dict((name.split('.', 1)[1], round(secs * 1e3, 3))
+        for name, secs in self.radio.metrics.values.items() if name.startswith('boot.')),
+      'frames': len(frames),
+      'i2c_bytes_per_frame': float(sum(frames)) / len(frames) if frames else None,
+      'i2c': self.bus.stats(),
+      'lcd': {
+        'polls': self.lcd.polls,
+        'polls_avoided': self.lcd.polls_avoided,
+        'busy_violations': self.bus.lcd.busy_violations,
+      },
+      'idle_playback': self.idle,
+      'mpd_round_trips': dict(self.player.calls),
+    }
+
+  @staticmethod
+  def _stats(values, missed):
+    ms = lambda v: None if v is None else round(v * 1e3, 2)
+    return {
+      'n': len(values),
+      'no_frame': missed,
+      'p50': ms(percentile(values, 50)),
+      'p99': ms(percentile(values, 99)),
+      'max': ms(max(values) if values else None),
+    }
+
+
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark the radio UI on emulated hardware')
+  parser.add_argument('-o', '--output', help='write the JSON results here instead of stdout')
+  parser.add_argument('--idle', type=float, default=60, help='seconds of idle playback (%(default)s)')
+  parser.add_argument('--meta', type=float, default=10, help='seconds between stream titles (%(default)s)')
+  parser.add_argument('--timing', choices=('poll', 'deadline'), default='poll', help='LCD timing (%(default)s)')
+  parser.add_argument('--interrupt', action='store_true', help='read the buttons on interrupt')
+  parser.add_argument('--latency', type=float, default=0, help='extra seconds per I2C transaction')
+  parser.add_argument('--mpd-delay', type=float, default=0, help='seconds per mpd response')
+  args = parser.parse_args()
+
+  results = Bench(args).run()
+  out = open(args.output, 'w') if args.output else sys.stdout
+  json.dump(results, out, indent=2, sort_keys=True, separators=(',', ': '))
+  out.write('\n')
+  if args.output:
+    out.close()
@@ -0,0 +1,50 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: ts=2 sts=2 sw=2 et si
+#
+# Monotonic clock for python 2
+# by sdb
+#
+# time.monotonic() only exists from python 3.3 on.  Before that use
+# clock_gettime(CLOCK_MONOTONIC) through ctypes, and only if that is not
+# available either fall back to the wall clock.
+#
+# Open source. MIT license
+
+
+import ctypes
+import ctypes.util
+import os
+import time
+
+
+CLOCK_MONOTONIC = 1
+
+
+class _timespec(ctypes.Structure):
+  _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _clock_gettime():
+  libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+  gettime = libc.clock_gettime
+  gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+  def monotonic():
+    'Seconds of the monotonic clock'
+    # a timespec per call, threads read the clock at the same time
+    ts = _timespec()
+    if gettime(CLOCK_MONOTONIC, ctypes.byref(ts)):
+      errno = ctypes.get_errno()
+      raise OSError(errno, os.strerror(errno))
+    return ts.tv_sec + ts.tv_nsec * 1e-9
+  monotonic()
+  return monotonic
+
+
+try:
+  monotonic = time.monotonic
+except AttributeError:
+  try:
+    monotonic = _clock_gettime()
+  except (OSError, AttributeError):
+    monotonic = time.time
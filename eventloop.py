@@ -0,0 +1,377 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: ts=2 sts=2 sw=2 et si
+#
+# Small event loop for the radio
+# by sdb
+#
+# Python 2 has no asyncio, so this is the thread based equivalent:
+# one loop thread runs all of the application logic, blocking I/O (I2C,
+# mpd, subprocesses) goes to named single threaded executors that post
+# their results back to the loop.
+#
+# Open source. MIT license
+
+
+import errno
+import fcntl
+import functools
+import heapq
+import os
+import select
+import threading
+import Queue
+from collections import deque
+from clock import monotonic
+from metrics import Metrics
+
+
+DEBUG = 0
+MAXWAIT = 1.0   # longest wait, a signal may not interrupt it
+
+
+
+
+class Cancelled(Exception):
+  ''' The exception of a Future cancelled before it ran '''
+  pass
+
+
+
+
+class Future(object):
+  ''' Result of a call handed to an executor '''
+
+  def __init__(self):
+    self._done = threading.Event()
+    self._lock = threading.Lock()
+    self._running = False
+    self._result = None
+    self._exception = None
+    self._callbacks = []
+
+  def done(self):
+    return self._done.is_set()
+
+  def result(self, timeout=None):
+    if not self._done.wait(timeout):
+      raise RuntimeError('timeout waiting for result')
+    if self._exception is not None:
+      raise self._exception
+    return self._result
+
+  def exception(self):
+    return self._exception
+
+  def _finish(self, result, exception):
+    with self._lock:
+      self._result, self._exception = result, exception
+      self._done.set()
+      callbacks, self._callbacks = self._callbacks, []
+    for fn in callbacks:
+      fn(self)
+
+  def start(self):
+    'Mark it running, False if it was cancelled'
+    with self._lock:
+      if self._done.is_set():
+        return False
+      self._running = True
+      return True
+
+  def cancel(self):
+    'Finish it with Cancelled unless it runs or ran already, True if it did'
+    with self._lock:
+      if self._running or self._done.is_set():
+        return False
+      self._exception = Cancelled()
+      self._done.set()
+      callbacks, self._callbacks = self._callbacks, []
+    for fn in callbacks:
+      fn(self)
+    return True
+
+  def set_result(self, result):
+    self._finish(result, None)
+
+  def set_exception(self, exception):
+    self._finish(None, exception)
+
+  def add_done_callback(self, fn):
+    'Call fn(future) when done, on the thread that finishes it'
+    with self._lock:
+      if not self._done.is_set():
+        self._callbacks.append(fn)
+        return
+    fn(self)
+
+
+
+
+class Executor(object):
+  '''
+  Runs calls one after another on its own thread
+
+  A call submitted to a slot supersedes the one before it in that slot
+  if that one did not start yet: of a burst only the last one runs.
+  '''
+
+  def __init__(self, name):
+    self.name = name
+    self._calls = Queue.Queue()
+    self._slots = {}
+    self._lock = threading.Lock()
+    self._thread = threading.Thread(target=self._run, name=name)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def __repr__(self):
+    return 'executor: ' + self.name
+
+  def submit(self, fn, *args):
+    future = Future()
+    self._calls.put((future, fn, args))
+    return future
+
+  def replace(self, slot, fn, *args):
+    'submit(), cancelling the waiting call of slot'
+    with self._lock:
+      waiting = self._slots.get(slot)
+      if waiting is not None and waiting.cancel():
+        if DEBUG: print '%r: %s superseded' % (self, slot)
+      future = self._slots[slot] = self.submit(fn, *args)
+    return future
+
+  def _run(self):
+    while True:
+      call = self._calls.get()
+      if call is None:
+        break
+      future, fn, args = call
+      if not future.start():
+        continue
+      try:
+        result = fn(*args)
+      except Exception as e:
+        print "Error: %r %s: %s" % (self, getattr(fn, '__name__', fn), e)
+        future.set_exception(e)
+      else:
+        future.set_result(result)
+
+  def shutdown(self, timeout=None):
+    'Finish the queued calls and stop the thread'
+    self._calls.put(None)
+    self._thread.join(timeout)
+
+
+
+
+class Proxy(object):
+  '''
+  Forwards method calls on obj to an executor of the loop, so they run
+  in order on that thread.  Each call returns a Future.
+  '''
+
+  def __init__(self, obj, loop, executor):
+    self._obj = obj
+    self._loop = loop
+    self._executor = executor
+
+  def __repr__(self):
+    return 'proxy: %r' % self._obj
+
+  def __getattr__(self, name):
+    attr = getattr(self._obj, name)
+    if not callable(attr):
+      return attr
+    def call(*args, **kwargs):
+      fn = functools.partial(attr, **kwargs) if kwargs else attr
+      return self._loop.run_in_executor(self._executor, fn, *args)
+    call.__name__ = name
+    return call
+
+
+
+
+class Timer(object):
+  ''' A call scheduled on the loop, cancel() keeps it from being called '''
+
+  def __init__(self, when, fn, args, every=None):
+    self.when = when
+    self.fn = fn
+    self.args = args
+    self.every = every
+    self.cancelled = False
+
+  def __repr__(self):
+    return 'timer: %s at %.3f%s' % (getattr(self.fn, '__name__', self.fn), self.when,
+      ' every %gs' % self.every if self.every else '')
+
+  def __lt__(self, other):
+    return self.when < other.when
+
+  def cancel(self):
+    self.cancelled = True
+
+
+
+
+class EventLoop(object):
+  '''
+  Runs callbacks posted from any thread, and timers, on the thread
+  calling run()
+
+  run() may be nested: an applet started from a handler runs its own
+  loop on the same queue until it finishes, then the outer one resumes.
+  Each run() has its own timers, those of an outer run wait meanwhile.
+  An exception raised by a callback ends run() with that exception.
+
+  The time each callback and timer takes goes to metrics ('loop.event',
+  'loop.timer'), and how late the timers are called ('loop.late').
+  '''
+
+  def __init__(self, metrics=None):
+    self.metrics = metrics or Metrics()
+    self._events = deque()
+    # a byte in the pipe wakes the loop for an event
+    self._wakeup = os.pipe()
+    for fd in self._wakeup:
+      fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    self._executors = {}
+    self._lock = threading.Lock()
+    self._timers = []   # a heap per run(), innermost last
+    self._runs = 0
+    self._resumed = 0
+
+  def call_soon(self, fn, *args):
+    'Run fn(*args) on the loop thread, may be called from any thread'
+    self._events.append((fn, args))
+    try:
+      os.write(self._wakeup[1], 'x')
+    except OSError:
+      pass  # full, it wakes anyway
+
+  def call_at(self, when, fn, *args):
+    '''
+    Run fn(*args) at monotonic time when, returns its Timer.  Only
+    from the loop thread, within run(): the timer belongs to that run
+    '''
+    timer = Timer(when, fn, args)
+    heapq.heappush(self._timers[-1], timer)
+    return timer
+
+  def call_later(self, delay, fn, *args):
+    'Run fn(*args) in delay seconds, see call_at()'
+    return self.call_at(monotonic() + delay, fn, *args)
+
+  def call_every(self, interval, fn, *args):
+    '''
+    Run fn(*args) every interval seconds, first in interval seconds,
+    see call_at().  It keeps to its deadlines, a late call does not
+    delay the next, calls missed altogether are skipped.
+    '''
+    timer = self.call_later(interval, fn, *args)
+    timer.every = interval
+    return timer
+
+  def executor(self, name):
+    with self._lock:
+      if name not in self._executors:
+        self._executors[name] = Executor(name)
+      return self._executors[name]
+
+  def run_in_executor(self, name, fn, *args):
+    'Run fn(*args) on the named executor thread, returns a Future'
+    return self.executor(name).submit(fn, *args)
+
+  def run_latest(self, name, slot, fn, *args):
+    '''
+    run_in_executor(), unless a later call for slot comes before it
+    starts: then its Future is cancelled (the then() callback not called)
+    '''
+    return self.executor(name).replace(slot, fn, *args)
+
+  def then(self, future, fn, errback=None):
+    '''
+    Call fn(result) on the loop thread once future succeeded, or
+    errback(exception) if it failed (not if it was cancelled)
+    '''
+    def done(future):
+      e = future.exception()
+      if e is None:
+        self.call_soon(fn, future.result())
+      elif errback and not isinstance(e, Cancelled):
+        self.call_soon(errback, e)
+    future.add_done_callback(done)
+
+  def run(self, start=None):
+    '''
+    Run timers and posted callbacks until one raises, waiting for the
+    next event or timer in between.  start() is called first, to set
+    the timers of this run.
+    '''
+    timers = []
+    self._timers.append(timers)
+    self._runs += 1
+    try:
+      if start:
+        start()
+      while True:
+        timeout = MAXWAIT
+        while timers:
+          timer = timers[0]
+          if timer.cancelled:
+            heapq.heappop(timers)
+            continue
+          now = monotonic()
+          if timer.when > now:
+            timeout = min(timeout, timer.when - now)
+            break
+          if timer.when > self._resumed:
+            self.metrics.observe('loop.late', now - timer.when)
+          if timer.every:
+            timer.when += timer.every
+            if timer.when <= now:
+              timer.when = now + timer.every
+            heapq.heapreplace(timers, timer)
+          else:
+            heapq.heappop(timers)
+          if DEBUG > 1: print timer
+          self._call('loop.timer', timer.fn, timer.args)
+          timeout = 0
+          break
+        if self._events:
+          fn, args = self._events.popleft()
+          self._call('loop.event', fn, args)
+        elif timeout:
+          self._wait(timeout)
+    finally:
+      self._timers.pop()
+
+  def _call(self, name, fn, args):
+    'fn(*args), timed unless an applet ran in it (a nested run)'
+    runs = self._runs
+    start = monotonic()
+    fn(*args)
+    if runs == self._runs:
+      self.metrics.observe(name, monotonic() - start)
+    else:
+      # the timers of this run waited for it, they are late
+      self._resumed = monotonic()
+
+  def _wait(self, timeout):
+    'Sleep until an event is posted or for timeout seconds'
+    try:
+      select.select([self._wakeup[0]], [], [], timeout)
+    except select.error as e:
+      if e.args[0] != errno.EINTR:
+        raise
+    try:
+      os.read(self._wakeup[0], 4096)
+    except OSError:
+      pass
+
+  def shutdown(self, timeout=5):
+    'Let the executors finish what is queued'
+    for executor in self._executors.values():
+      executor.shutdown(timeout)
@@ -0,0 +1,566 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: ts=2 sts=2 sw=2 et si
+#
+# Hardware free stand-in for smbus.SMBus with the LCD plate on it
+# by sdb
+#
+# Emulates the MCP23017 at register level (both IOCON.BANK layouts,
+# sequential or byte mode, pull-ups, polarity, interrupt-on-change) and
+# the HD44780 behind its port B, decoded from the enable strobes like the
+# real controller does.  Counts the I2C traffic per smbus method and can
+# take as long as the real bus, so the drivers can be benchmarked without
+# a Pi:
+#
+#   bus = FakePlate()
+#   lcd = Adafruit_CharLCDPlate(bus=bus, interrupt=bus.int)
+#   bus.press(lcd.SELECT)
+#   print bus.lcd.text()
+#
+# Open source. MIT license
+
+
+import threading
+import time
+from collections import defaultdict
+
+from clock import monotonic
+
+
+DEBUG = 0
+BITRATE = 100000  # standard mode I2C, 9 bit times per byte with the ack
+
+
+
+
+class HD44780(object):
+  '''
+  The LCD controller as seen through its 4 bit interface
+
+  Every instruction is timed by the clock of the bus.  One arriving while
+  the previous is still executing is counted in busy_violations, on real
+  hardware it would be lost.
+  '''
+
+  EXECTIME = 37e-6    # most instructions
+  SLOWTIME = 1.52e-3  # clear and home
+  WIDTH = 40          # display RAM per line
+
+  def __init__(self, clock=monotonic):
+    self.clock = clock
+    self.ddram = bytearray(' ' * 0x80)
+    self.cgram = bytearray(64)
+    self.addr = 0
+    self.cgmode = False
+    self.increment = True
+    self.autoshift = False
+    self.shift = 0
+    self.display_on = False
+    self.eightbit = True   # the power on state, until a function set
+    self.nibble = None     # first half of a byte in 4 bit mode
+    self.readhigh = True   # next read strobe returns the high nibble
+    self.busy_until = 0
+    self.instructions = 0
+    self.characters = 0
+    self.busy_violations = 0
+
+  def __repr__(self):
+    return 'hd44780: %r' % self.text()
+
+  def busy(self):
+    return self.clock() < self.busy_until
+
+  def strobe(self, rs, nibble):
+    'E went low with R/W low: latch D7..D4'
+    if self.eightbit:
+      # only the high nibble is wired, the low one reads as 0
+      self.nibble = None
+      self.execute(rs, nibble << 4)
+    elif self.nibble is None:
+      self.nibble = nibble
+    else:
+      value, self.nibble = (self.nibble << 4) | nibble, None
+      self.execute(rs, value)
+
+  def read(self, rs):
+    'E went high with R/W high: what the LCD drives on D7..D4'
+    if rs:
+      value = (self.cgram[self.addr & 0x3F] if self.cgmode else self.ddram[self.addr])
+    else:
+      value = (0x80 if self.busy() else 0) | self.addr
+    high, self.readhigh = self.readhigh, not self.readhigh or self.eightbit
+    return value >> 4 if high else value & 0x0F
+
+  def _advance(self):
+    step = 1 if self.increment else -1
+    if self.cgmode:
+      self.addr = (self.addr + step) & 0x3F
+    elif step > 0:
+      self.addr = 0x40 if self.addr == 0x27 else 0x00 if self.addr == 0x67 else self.addr + 1
+    else:
+      self.addr = 0x67 if self.addr == 0x00 else 0x27 if self.addr == 0x40 else self.addr - 1
+    if self.autoshift and not self.cgmode:
+      self.shift = (self.shift + step) % self.WIDTH
+
+  def execute(self, rs, value):
+    now = self.clock()
+    if now < self.busy_until:
+      self.busy_violations += 1
+      if DEBUG: print 'lcd busy for %.0f us, got %s 0x%02x' % (
+        (self.busy_until - now) * 1e6, 'data' if rs else 'instruction', value)
+    self.readhigh = True
+    duration = self.EXECTIME
+    if rs:
+      self.characters += 1
+      if self.cgmode:
+        self.cgram[self.addr] = value
+      else:
+        self.ddram[self.addr] = value
+      self._advance()
+    else:
+      self.instructions += 1
+      if value & 0x80:
+        self.addr, self.cgmode = value & 0x7F, False
+      elif value & 0x40:
+        self.addr, self.cgmode = value & 0x3F, True
+      elif value & 0x20:
+        self.eightbit = bool(value & 0x10)
+      elif value & 0x10:
+        step = 1 if value & 0x04 else -1
+        if value & 0x08:
+          self.shift = (self.shift - step) % self.WIDTH
+        else:
+          save, self.increment = self.increment, step > 0
+          self._advance()
+          self.increment = save
+      elif value & 0x08:
+        self.display_on = bool(value & 0x04)
+      elif value & 0x04:
+        self.increment = bool(value & 0x02)
+        self.autoshift = bool(value & 0x01)
+      elif value & 0x02:
+        self.addr, self.cgmode, self.shift = 0, False, 0
+        duration = self.SLOWTIME
+      elif value & 0x01:
+        self.ddram[:] = ' ' * 0x80
+        self.addr, self.cgmode, self.shift = 0, False, 0
+        self.increment = True
+        duration = self.SLOWTIME
+    self.busy_until = now + duration
+
+  def line(self, row, cols=16):
+    'The characters visible on a row'
+    base = 0x40 * row
+    return str(bytearray(self.ddram[base + (self.shift + i) % self.WIDTH] for i in range(cols)))
+
+  def text(self, rows=2, cols=16):
+    'What the display shows, blank when switched off'
+    if not self.display_on:
+      return '\n'.join([' ' * cols] * rows)
+    return '\n'.join(self.line(row, cols) for row in range(rows))
+
+
+
+
+class MCP23017(object):
+  '''
+  The port expander as seen over I2C
+
+  Registers are kept per port in bank 1 order and mapped from the
+  addresses of whichever IOCON.BANK layout is active.  inputs holds the
+  levels driven from outside, None where nothing drives the pin (it
+  reads its pull-up).  Port B may have an HD44780 on the plate wiring.
+  '''
+
+  IODIR, IPOL, GPINTEN, DEFVAL, INTCON, IOCON, GPPU, INTF, INTCAP, GPIO, OLAT = range(11)
+
+  # IOCON bits
+  BANK = 0x80
+  MIRROR = 0x40
+  SEQOP = 0x20
+
+  def __init__(self, lcd=None):
+    self.regs = [[0] * 11, [0] * 11]
+    self.regs[0][self.IODIR] = self.regs[1][self.IODIR] = 0xFF
+    self.inputs = [[None] * 8, [None] * 8]
+    self.pointer = 0
+    self.lcd = lcd
+    self.pins = [self._levels(0), self._levels(1)]
+    self.listeners = []
+
+  def __repr__(self):
+    return 'mcp23017: A=%02x B=%02x' % tuple(self._levels(p) for p in (0, 1))
+
+
+  # ----------------------------------------------------------------------
+  # Register access
+
+  def _decode(self, address):
+    'The (port, register) at an address, None if there is none'
+    if self.regs[0][self.IOCON] & self.BANK:
+      port, reg = address >> 4, address & 0x0F
+      if port > 1 or reg > self.OLAT:
+        return None
+    else:
+      port, reg = address & 1, address >> 1
+      if reg > self.OLAT:
+        return None
+    return port, reg
+
+  def _next(self):
+    '''
+    Move the address pointer on after a byte.  In byte mode it stays,
+    or with bank 0 toggles between the A and B register of a pair.
+    '''
+    iocon = self.regs[0][self.IOCON]
+    if iocon & self.SEQOP:
+      if not iocon & self.BANK:
+        self.pointer ^= 1
+    elif iocon & self.BANK:
+      self.pointer = (self.pointer + 1) & 0x1F
+    else:
+      self.pointer = (self.pointer + 1) % 0x16
+
+  # What the bus does with a device: the first byte written sets the
+  # address pointer, every further byte written or read moves it on.
+
+  def start(self, address):
+    self.pointer = address
+
+  def put(self, value):
+    self.poke(self.pointer, value)
+    self._next()
+
+  def get(self):
+    value = self.peek(self.pointer)
+    self._next()
+    return value
+
+  def poke(self, address, value):
+    where = self._decode(address)
+    if where is None:
+      return
+    port, reg = where
+    if reg == self.IOCON:
+      # one register at two addresses
+      self.regs[0][reg] = self.regs[1][reg] = value & 0xFE
+    elif reg == self.GPIO or reg == self.OLAT:
+      self.regs[port][self.OLAT] = value
+    elif reg in (self.INTF, self.INTCAP):
+      return  # read only
+    else:
+      self.regs[port][reg] = value
+    self._update(port)
+
+  def peek(self, address):
+    where = self._decode(address)
+    if where is None:
+      return 0
+    port, reg = where
+    regs = self.regs[port]
+    if reg == self.GPIO:
+      value = self._levels(port)
+      value ^= regs[self.IPOL] & regs[self.IODIR]
+      self._clear(port)
+      return value
+    if reg == self.INTCAP:
+      value = regs[reg]
+      self._clear(port)
+      return value
+    return regs[reg]
+
+
+  # ----------------------------------------------------------------------
+  # Pins
+
+  def _levels(self, port):
+    'The pin levels of a port'
+    regs = self.regs[port]
+    value = 0
+    for bit in range(8):
+      mask = 1 << bit
+      if not regs[self.IODIR] & mask:
+        level = regs[self.OLAT] & mask
+      elif self.inputs[port][bit] is not None:
+        level = self.inputs[port][bit]
+      else:
+        level = regs[self.GPPU] & mask
+      if level:
+        value |= mask
+    return value
+
+  def _update(self, port):
+    'Settle the pins after a change: LCD strobes, then interrupts'
+    before = self.pins[port]
+    now = self._levels(port)
+    if port == 1 and self.lcd is not None:
+      now = self._lcd(before, now)
+    self.pins[port] = now
+    if now != before:
+      self._change(port, before, now)
+
+  def _lcd(self, before, now):
+    'Port B pin changes as seen by the LCD: PB7 RS, PB6 R/W, PB5 E, PB4..1 D4..D7'
+    rs, rw = now & 0x80, now & 0x40
+    if (before & 0x20) and not (now & 0x20) and not rw:
+      self.lcd.strobe(rs, ((now >> 4) & 1) | ((now >> 2) & 2) | (now & 4) | ((now << 2) & 8))
+    if not (before & 0x20) and (now & 0x20) and rw:
+      nibble = self.lcd.read(rs)
+      drive = ((nibble & 1) << 4) | ((nibble & 2) << 2) | (nibble & 4) | ((nibble & 8) >> 2)
+      for bit in range(1, 5):
+        self.inputs[1][bit] = (drive >> bit) & 1
+      now = self._levels(1)
+    elif not rw and self.inputs[1][1:5] != [None] * 4:
+      self.inputs[1][1:5] = [None] * 4
+      now = self._levels(1)
+    return now
+
+  def _change(self, port, before, now):
+    regs = self.regs[port]
+    enabled = regs[self.GPINTEN] & regs[self.IODIR]
+    if not enabled:
+      return
+    compare = (regs[self.DEFVAL] & regs[self.INTCON]) | (before & ~regs[self.INTCON])
+    fired = (now ^ compare) & enabled
+    if fired:
+      if not regs[self.INTF]:
+        regs[self.INTCAP] = now ^ (regs[self.IPOL] & regs[self.IODIR])
+      regs[self.INTF] |= fired
+      self._signal()
+
+  def _clear(self, port):
+    regs = self.regs[port]
+    if regs[self.INTF]:
+      regs[self.INTF] = 0
+      # a level compare fires again right away while the pin differs
+      compare = regs[self.DEFVAL] & regs[self.INTCON] & regs[self.GPINTEN]
+      if (self.pins[port] ^ regs[self.DEFVAL]) & compare:
+        regs[self.INTF] = (self.pins[port] ^ regs[self.DEFVAL]) & compare
+        regs[self.INTCAP] = self.pins[port] ^ (regs[self.IPOL] & regs[self.IODIR])
+      self._signal()
+
+  def interrupt(self, port=0):
+    'State of the INTA/INTB pin (as asserted, whatever its polarity)'
+    if self.regs[0][self.IOCON] & self.MIRROR:
+      return bool(self.regs[0][self.INTF] or self.regs[1][self.INTF])
+    return bool(self.regs[port][self.INTF])
+
+  def _signal(self):
+    for fn in self.listeners:
+      fn()
+
+  def drive(self, port, bit, level):
+    'Drive an input pin from outside, None lets go of it'
+    self.inputs[port][bit] = level
+    self._update(port)
+
+
+
+
+class InterruptLine(object):
+  '''
+  The MCP23017 INT pin, same interface as gpiochip.LineEvent
+  '''
+
+  def __init__(self, mcp, port=0):
+    self.mcp = mcp
+    self.port = port
+    self._cond = threading.Condition()
+    mcp.listeners.append(self._changed)
+
+  def __repr__(self):
+    return 'line: %r INT%s' % (self.mcp, 'AB'[self.port])
+
+  def _changed(self):
+    with self._cond:
+      self._cond.notify_all()
+
+  def asserted(self):
+    return self.mcp.interrupt(self.port)
+
+  def wait(self, timeout=None):
+    'Wait up to timeout seconds for the line, True if asserted'
+    deadline = None if timeout is None else monotonic() + timeout
+    with self._cond:
+      while not self.asserted():
+        left = None if deadline is None else deadline - monotonic()
+        if left is not None and left <= 0:
+          return False
+        # bounded so it wakes up even if a signal is lost
+        self._cond.wait(0.1 if left is None else min(left, 0.1))
+      return True
+
+  def close(self):
+    pass
+
+
+
+
+class FakeSMBus(object):
+  '''
+  smbus.SMBus for emulated devices, {address: device}
+
+  Every transaction is counted per method (transactions, bytes including
+  the register address) and takes latency plus the wire time of its bytes
+  at bitrate.  With realtime the call sleeps for it, otherwise only the
+  bus clock (used for the LCD instruction timing) moves on.
+  '''
+
+  def __init__(self, devices=None, latency=0, bitrate=BITRATE, realtime=True):
+    self.devices = dict(devices or {})
+    self.latency = latency
+    self.bitrate = bitrate
+    self.realtime = realtime
+    self.now = 0
+    self.lock = threading.RLock()
+    self.reset()
+
+  def reset(self):
+    'Zero the counters'
+    self.transactions = defaultdict(int)
+    self.bytes = defaultdict(int)
+    self.bustime = 0
+
+  def stats(self):
+    return {
+      'transactions': dict(self.transactions),
+      'bytes': dict(self.bytes),
+      'total_transactions': sum(self.transactions.values()),
+      'total_bytes': sum(self.bytes.values()),
+      'bustime': self.bustime,
+    }
+
+  def clock(self):
+    'Time on the bus, the wire time of the byte being handled'
+    return self.now
+
+  def close(self):
+    pass
+
+  def _device(self, addr):
+    try:
+      return self.devices[addr]
+    except KeyError:
+      raise IOError(121, 'Remote I/O error')
+
+  def _transfer(self, method, addr, write, read=0):
+    '''
+    One transaction: write the bytes, then read some (a repeated start,
+    so it counts as one), return what was read
+    '''
+    with self.lock:
+      device = self._device(addr)
+      self.transactions[method] += 1
+      self.bytes[method] += len(write) + read
+      bytetime = 9.0 / self.bitrate
+      start = max(self.now, monotonic())
+      # the device address byte, and again after a repeated start
+      self.now = start + self.latency + bytetime
+      data = []
+      if write:
+        device.start(write[0])
+        for value in write[1:]:
+          self.now += bytetime
+          device.put(value)
+        self.now += bytetime
+      if read:
+        if write:
+          self.now += bytetime
+        for i in range(read):
+          self.now += bytetime
+          data.append(device.get())
+      self.bustime += self.now - start
+      if self.realtime:
+        left = self.now - monotonic()
+        if left > 0:
+          time.sleep(left)
+      return data
+
+  def write_quick(self, addr):
+    self._transfer('write_quick', addr, [])
+
+  def read_byte(self, addr):
+    return self._transfer('read_byte', addr, [], 1)[0]
+
+  def write_byte(self, addr, val):
+    self._transfer('write_byte', addr, [val])
+
+  def read_byte_data(self, addr, cmd):
+    return self._transfer('read_byte_data', addr, [cmd], 1)[0]
+
+  def write_byte_data(self, addr, cmd, val):
+    self._transfer('write_byte_data', addr, [cmd, val])
+
+  def read_word_data(self, addr, cmd):
+    lo, hi = self._transfer('read_word_data', addr, [cmd], 2)
+    return lo | (hi << 8)
+
+  def write_word_data(self, addr, cmd, val):
+    self._transfer('write_word_data', addr, [cmd, val & 0xFF, (val >> 8) & 0xFF])
+
+  def read_i2c_block_data(self, addr, cmd, length=32):
+    if length > 32:
+      raise IOError(22, 'Invalid argument')
+    return self._transfer('read_i2c_block_data', addr, [cmd], length)
+
+  def write_i2c_block_data(self, addr, cmd, vals):
+    if len(vals) > 32:
+      raise IOError(22, 'Invalid argument')
+    self._transfer('write_i2c_block_data', addr, [cmd] + list(vals))
+
+
+
+
+class FakePlate(FakeSMBus):
+  '''
+  The bus with an Adafruit LCD plate at addr: buttons on port A with the
+  plate's pull-ups, backlight on PA6/PA7/PB0 and the LCD on port B
+  '''
+
+  BUTTONS = 5
+
+  def __init__(self, addr=0x20, **kwargs):
+    super(FakePlate, self).__init__(**kwargs)
+    self.lcd = HD44780(self.clock)
+    self.mcp = MCP23017(self.lcd)
+    self.devices[addr] = self.mcp
+    self.int = InterruptLine(self.mcp)
+
+  def press(self, *buttons):
+    'Press buttons (pin numbers of port A, like lcd.SELECT), they short to ground'
+    with self.lock:
+      for b in buttons:
+        self.mcp.drive(0, b, 0)
+
+  def release(self, *buttons):
+    'Release buttons, all of them without arguments'
+    with self.lock:
+      for b in (buttons or range(self.BUTTONS)):
+        self.mcp.drive(0, b, None)
+
+  def pressed(self):
+    'Pin numbers of the buttons held'
+    return [b for b in range(self.BUTTONS) if self.mcp.inputs[0][b] == 0]
+
+  def backlight(self):
+    'The backlight color bits (1 red, 2 green, 4 blue), the LEDs are active low'
+    a, b = self.mcp.pins
+    return ((~a >> 6) & 0b011) | ((~b << 2) & 0b100)
+
+
+
+
+if __name__ == '__main__':
+  from Adafruit_CharLCDPlate import Adafruit_CharLCDPlate
+  for timing in ('poll', 'deadline'):
+    bus = FakePlate()
+    lcd = Adafruit_CharLCDPlate(bus=bus, interrupt=bus.int, timing=timing)
+    bus.reset()
+    lcd.clear()
+    lcd.message('Adafruit RGB LCD\nPlate w/Keypad!')
+    print bus.lcd.text()
+    bus.press(lcd.SELECT)
+    print timing, bus.int.wait(0), lcd.waitButtons(0), bus.int.wait(0)
+    print bus.stats()
+    print 'instructions %d, characters %d, busy violations %d' % (
+      bus.lcd.instructions, bus.lcd.characters, bus.lcd.busy_violations)
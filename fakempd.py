@@ -0,0 +1,484 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: ts=2 sts=2 sw=2 et si
+#
+# Stand-in mpd server for tests and load runs
+# by sdb
+#
+# Speaks enough of the mpd protocol on a loopback port for the radio:
+# status, currentsong, setvol, volume, single, load, play, stop, clear,
+# listplaylists, idle/noidle and command lists.  No audio, the "streams"
+# only have a name and a title that changes every now and then.  Every
+# response can be delayed and commands can be made to fail or to drop
+# the connection, to see how the radio copes with a slow or flaky daemon.
+#
+#   server = FakeMPDServer(delay=0.05).start()
+#   client = mpdclient.MPDClient(*server.address)
+#
+# or standalone, for the real radio.py (MPD_PORT=6601):
+#
+#   python fakempd.py --port 6601 --delay 0.05 --meta 10
+#
+# Open source. MIT license
+
+
+import random
+import select
+import shlex
+import socket
+import SocketServer
+import threading
+from collections import defaultdict
+from time import sleep, strftime
+
+
+DEBUG = 0
+VERSION = '0.21.0'
+STATIONS = 30
+SUBSYSTEMS = ('database', 'update', 'stored_playlist', 'playlist', 'player',
+              'mixer', 'output', 'options', 'sticker', 'subscription', 'message')
+
+# stream titles, short and longer than the display and its RAM
+TITLES = (
+  'Short title',
+  'Artist - A title that scrolls',
+  'Some Band - A very long title that is longer than the display RAM',
+  '',
+)
+
+# mpd ack codes
+ACK_ERROR_ARG = 2
+ACK_ERROR_UNKNOWN = 5
+ACK_ERROR_NO_EXIST = 50
+ACK_ERROR_SYSTEM = 52
+
+
+
+
+class Ack(Exception):
+  def __init__(self, code, message):
+    super(Ack, self).__init__(message)
+    self.code = code
+
+
+class Drop(Exception):
+  ''' close the connection without an answer '''
+
+
+
+
+class Player(object):
+  '''
+  The state of the fake daemon, shared by all connections
+
+  playlists maps a name to its streams, each a dict of tags.  Changes
+  bump a version per subsystem, which is what idle waits for.  The
+  commands handled are counted in calls, a command list as one.
+  '''
+
+  def __init__(self, stations=STATIONS):
+    self.playlists = dict(
+      ('Station %02d' % (i + 1), [{
+        'file': 'http://stream.example/%d' % (i + 1),
+        'Name': 'Station %02d, Fake FM' % (i + 1),
+      }]) for i in range(stations))
+    self.queue = []
+    self.pos = None
+    self.state = 'stop'
+    self.volume = 70
+    self.single = 0
+    self.title = TITLES[0]
+    self.titles = 0
+    self.calls = defaultdict(int)
+    self.versions = defaultdict(int)
+    self.cond = threading.Condition()
+
+  def changed(self, *subsystems):
+    with self.cond:
+      for s in subsystems:
+        self.versions[s] += 1
+      self.cond.notify_all()
+
+  def retitle(self, title=None):
+    'New stream metadata, the next of TITLES by default'
+    with self.cond:
+      self.titles += 1
+      self.title = TITLES[self.titles % len(TITLES)] if title is None else title
+      if self.state != 'stop':
+        self.changed('player')
+
+  def store(self, name, streams):
+    'Add or replace a stored playlist'
+    with self.cond:
+      self.playlists[name] = list(streams)
+      self.changed('stored_playlist')
+
+
+  # ----------------------------------------------------------------------
+  # Commands: (key, value) pairs or an Ack
+
+  def status(self):
+    pairs = [('volume', self.volume), ('repeat', 0), ('random', 0),
+             ('single', self.single), ('consume', 0), ('playlistlength', len(self.queue)),
+             ('state', self.state)]
+    if self.pos is not None:
+      pairs += [('song', self.pos), ('songid', self.pos + 1)]
+    return pairs
+
+  def currentsong(self):
+    if self.pos is None:
+      return []
+    song = self.queue[self.pos]
+    pairs = [('file', song['file'])]
+    if 'Name' in song:
+      pairs.append(('Name', song['Name']))
+    if self.title and self.state != 'stop':
+      pairs.append(('Title', self.title))
+    return pairs + [('Pos', self.pos), ('Id', self.pos + 1)]
+
+  def setvol(self, vol):
+    try:
+      vol = int(vol)
+    except ValueError:
+      raise Ack(ACK_ERROR_ARG, 'Integer expected: %s' % vol)
+    if not 0 <= vol <= 100:
+      raise Ack(ACK_ERROR_ARG, 'Invalid volume value')
+    if vol != self.volume:
+      self.volume = vol
+      self.changed('mixer')
+    return []
+
+  def volume_(self, change):
+    'The old relative volume command'
+    try:
+      return self.setvol(max(0, min(self.volume + int(change), 100)))
+    except ValueError:
+      raise Ack(ACK_ERROR_ARG, 'Integer expected: %s' % change)
+
+  def single_(self, state):
+    if state not in ('0', '1'):
+      raise Ack(ACK_ERROR_ARG, 'Boolean (0/1) expected: %s' % state)
+    if int(state) != self.single:
+      self.single = int(state)
+      self.changed('options')
+    return []
+
+  def load(self, name):
+    if name not in self.playlists:
+      raise Ack(ACK_ERROR_NO_EXIST, 'No such playlist')
+    self.queue = self.queue + self.playlists[name]
+    self.changed('playlist')
+    return []
+
+  def play(self, pos=None):
+    if pos is None:
+      pos = self.pos or 0
+    try:
+      pos = int(pos)
+    except ValueError:
+      raise Ack(ACK_ERROR_ARG, 'Integer expected: %s' % pos)
+    if not 0 <= pos < len(self.queue):
+      raise Ack(ACK_ERROR_ARG, 'Bad song index')
+    self.pos, self.state = pos, 'play'
+    self.changed('player')
+    return []
+
+  def stop(self):
+    if self.state != 'stop':
+      self.state = 'stop'
+      self.changed('player')
+    return []
+
+  def clear(self):
+    self.queue, self.pos = [], None
+    self.changed('playlist')
+    self.stop()
+    return []
+
+  def listplaylists(self):
+    modified = strftime('%Y-%m-%dT%H:%M:%SZ')
+    pairs = []
+    for name in sorted(self.playlists):
+      pairs += [('playlist', name), ('Last-Modified', modified)]
+    return pairs
+
+  def ping(self):
+    return []
+
+  def password(self, password):
+    return []
+
+  commands = {
+    'status': status, 'currentsong': currentsong, 'setvol': setvol,
+    'volume': volume_, 'single': single_, 'load': load, 'play': play, 'stop': stop,
+    'clear': clear, 'listplaylists': listplaylists, 'ping': ping,
+    'password': password,
+  }
+
+  def execute(self, cmd, args):
+    fn = self.commands.get(cmd)
+    if fn is None:
+      raise Ack(ACK_ERROR_UNKNOWN, 'unknown command "%s"' % cmd)
+    try:
+      with self.cond:
+        return fn(self, *args)
+    except TypeError:
+      raise Ack(ACK_ERROR_ARG, 'wrong number of arguments for "%s"' % cmd)
+
+
+
+
+class Handler(SocketServer.BaseRequestHandler):
+  ''' One client connection '''
+
+  def setup(self):
+    self.buf = ''
+    self.sock = self.request
+    self.server.connections[self.sock] = threading.current_thread()
+    # changes before the next idle are reported by it, like mpd does
+    with self.server.player.cond:
+      self.seen = dict(self.server.player.versions)
+
+  def finish(self):
+    self.server.connections.pop(self.sock, None)
+
+  def readline(self):
+    'The next line without the newline, None when the client is gone'
+    while '\n' not in self.buf:
+      try:
+        data = self.sock.recv(4096)
+      except socket.error:
+        return None
+      if not data:
+        return None
+      self.buf += data
+    line, self.buf = self.buf.split('\n', 1)
+    if DEBUG > 3: print 'fakempd <', line
+    return line
+
+  def pending(self):
+    'Is there input waiting'
+    return '\n' in self.buf or bool(select.select([self.sock], [], [], 0)[0])
+
+  def send(self, lines):
+    if DEBUG > 3: print 'fakempd >', lines
+    self.sock.sendall(''.join(l + '\n' for l in lines))
+
+  def handle(self):
+    server = self.server
+    self.send(['OK MPD ' + VERSION])
+    while True:
+      line = self.readline()
+      if line is None or line == 'close':
+        break
+      try:
+        if line in ('command_list_begin', 'command_list_ok_begin'):
+          lines = self.command_list(line == 'command_list_ok_begin')
+        elif line == 'idle' or line.startswith('idle '):
+          lines = self.idle(line)
+        elif line == 'noidle':
+          lines = []  # not idling, mpd ignores it
+        else:
+          cmd, args = self.parse(line)
+          server.before(cmd)
+          server.inject(cmd)
+          lines = self.pairs(server.player.execute(cmd, args)) + ['OK']
+      except Ack as e:
+        lines = [self.ack(e, 0, line.split(' ', 1)[0])]
+      except Drop:
+        break
+      if lines is None:
+        break
+      try:
+        self.send(lines)
+      except socket.error:
+        break
+
+  @staticmethod
+  def parse(line):
+    try:
+      words = shlex.split(line)
+    except ValueError as e:
+      raise Ack(ACK_ERROR_ARG, str(e))
+    if not words:
+      raise Ack(ACK_ERROR_UNKNOWN, 'No command given')
+    return words[0], words[1:]
+
+  @staticmethod
+  def pairs(pairs):
+    return ['%s: %s' % pair for pair in pairs]
+
+  @staticmethod
+  def ack(e, index, cmd):
+    return 'ACK [%d@%d] {%s} %s' % (e.code, index, cmd, e)
+
+  def command_list(self, ok):
+    'Read up to command_list_end, run the commands, the response'
+    cmds = []
+    while True:
+      line = self.readline()
+      if line is None:
+        return None
+      if line == 'command_list_end':
+        break
+      cmds.append(line)
+    self.server.before('command_list')
+    lines = []
+    for index, line in enumerate(cmds):
+      cmd = line.split(' ', 1)[0]
+      try:
+        cmd, args = self.parse(line)
+        self.server.inject(cmd)
+        lines += self.pairs(self.server.player.execute(cmd, args))
+      except Ack as e:
+        return lines + [self.ack(e, index, cmd)]
+      if ok:
+        lines.append('list_OK')
+    return lines + ['OK']
+
+  def changes(self, subsystems):
+    versions = self.server.player.versions
+    return [s for s in subsystems if versions[s] != self.seen.get(s, 0)]
+
+  def idle(self, line):
+    'Wait for a change or noidle, the changed subsystems'
+    cmd, subsystems = self.parse(line)
+    for s in subsystems:
+      if s not in SUBSYSTEMS:
+        raise Ack(ACK_ERROR_ARG, 'Unrecognized idle event: %s' % s)
+    self.server.before('idle', delay=False)
+    self.server.inject('idle')
+    player = self.server.player
+    subsystems = subsystems or SUBSYSTEMS
+    while True:
+      with player.cond:
+        changed = self.changes(subsystems)
+        if not changed:
+          player.cond.wait(0.05)
+          changed = self.changes(subsystems)
+        for s in changed:
+          self.seen[s] = player.versions[s]
+      if changed:
+        return ['changed: %s' % s for s in changed] + ['OK']
+      if self.server.stopping.is_set():
+        return None
+      if self.pending():
+        line = self.readline()
+        if line == 'noidle':
+          return ['OK']
+        # anything else while idle ends the connection, like mpd does
+        return None
+
+
+
+
+class FakeMPDServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+  '''
+  The fake daemon on a loopback port (0 picks a free one)
+
+  delay is the time every response takes, delays overrides it per
+  command.  fail maps commands to the number of times they fail with an
+  ACK, failrate and droprate are the chance any command fails or has the
+  connection dropped instead of an answer.  With meta the stream title
+  changes every meta seconds.
+  '''
+
+  allow_reuse_address = True
+  daemon_threads = True
+
+  def __init__(self, host='127.0.0.1', port=0, player=None, delay=0, delays=None,
+               fail=None, failrate=0, droprate=0, meta=None, seed=None):
+    SocketServer.TCPServer.__init__(self, (host, port), Handler)
+    self.player = player or Player()
+    self.delay = delay
+    self.delays = dict(delays or {})
+    self.fail = dict(fail or {})
+    self.failrate = failrate
+    self.droprate = droprate
+    self.meta = meta
+    self.random = random.Random(seed)
+    self.lock = threading.Lock()
+    self.stopping = threading.Event()
+    self.connections = {}
+    self.thread = None
+
+  def __repr__(self):
+    return 'fakempd: %s:%d' % self.address
+
+  @property
+  def address(self):
+    return self.server_address[:2]
+
+  def before(self, cmd, delay=True):
+    'Count a round trip, wait its delay and maybe drop the connection'
+    with self.lock:
+      self.player.calls[cmd] += 1
+      drop = self.random.random() < self.droprate
+    if delay:
+      sleep(self.delays.get(cmd, self.delay))
+    if drop:
+      raise Drop()
+
+  def inject(self, cmd):
+    'Fail cmd if configured to, also within a command list'
+    with self.lock:
+      if self.fail.get(cmd):
+        self.fail[cmd] -= 1
+        fail = True
+      else:
+        fail = self.random.random() < self.failrate
+    if fail:
+      raise Ack(ACK_ERROR_SYSTEM, 'injected failure')
+
+  def _metadata(self):
+    while not self.stopping.wait(self.meta):
+      self.player.retitle()
+
+  def start(self):
+    'Serve on a background thread, returns self'
+    self.thread = threading.Thread(target=self.serve_forever, name='fakempd')
+    self.thread.daemon = True
+    self.thread.start()
+    if self.meta:
+      meta = threading.Thread(target=self._metadata, name='fakempd-meta')
+      meta.daemon = True
+      meta.start()
+    return self
+
+  def stop(self):
+    'Stop serving and hang up on the clients'
+    self.stopping.set()
+    self.shutdown()
+    self.server_close()
+    for sock, thread in self.connections.items():
+      try:
+        sock.shutdown(socket.SHUT_RDWR)
+      except socket.error:
+        pass
+      thread.join(1)
+
+
+
+
+if __name__ == '__main__':
+  import argparse
+  parser = argparse.ArgumentParser(description='Fake mpd for the radio')
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=6601)
+  parser.add_argument('--stations', type=int, default=STATIONS, help='number of playlists (%(default)s)')
+  parser.add_argument('--delay', type=float, default=0, help='seconds per response')
+  parser.add_argument('--meta', type=float, help='seconds between stream titles')
+  parser.add_argument('--failrate', type=float, default=0, help='chance a command fails')
+  parser.add_argument('--droprate', type=float, default=0, help='chance a connection is dropped')
+  args = parser.parse_args()
+
+  server = FakeMPDServer(args.host, args.port, Player(args.stations), delay=args.delay,
+    failrate=args.failrate, droprate=args.droprate, meta=args.meta)
+  print 'listening on %s:%d' % server.address
+  server.start()
+  try:
+    while server.thread.is_alive():
+      server.thread.join(1)
+  except KeyboardInterrupt:
+    pass
+  server.stop()
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: ts=2 sts=2 sw=2 et si
+#
+# Wait for edges on a GPIO line through the Linux GPIO character device
+# by sdb
+#
+# Uses the v1 line event ioctl of /dev/gpiochipN, no extra modules.
+# Anything with the same wait(timeout) method can stand in for it,
+# e.g. to feed button interrupts from a test.
+#
+# Open source. MIT license
+
+
+import fcntl
+import os
+import select
+import struct
+
+
+# linux/gpio.h
+GPIOHANDLE_REQUEST_INPUT = 1 << 0
+GPIOEVENT_REQUEST_RISING_EDGE = 1 << 0
+GPIOEVENT_REQUEST_FALLING_EDGE = 1 << 1
+GPIO_GET_LINEEVENT_IOCTL = 0xC030B404       # _IOWR(0xB4, 0x04, struct gpioevent_request)
+GPIOHANDLE_GET_LINE_VALUES_IOCTL = 0xC040B408 # _IOWR(0xB4, 0x08, struct gpiohandle_data)
+GPIOEVENT_REQUEST = '=III32si'
+GPIOEVENT_DATA = '=QI4x'
+
+
+
+
+class LineEvent(object):
+  '''
+  An active low interrupt line, e.g. the MCP23017 INTA pin
+
+  wait(timeout) returns True as soon as the line is asserted, including
+  when it already was (an edge that happened before waiting is not lost).
+  '''
+
+  def __init__(self, line, chip='/dev/gpiochip0', label='radio', active_low=True):
+    self.line = line
+    self.chip = chip
+    self.active_low = active_low
+    edge = GPIOEVENT_REQUEST_FALLING_EDGE if active_low else GPIOEVENT_REQUEST_RISING_EDGE
+    req = bytearray(struct.pack(GPIOEVENT_REQUEST,
+      line, GPIOHANDLE_REQUEST_INPUT, edge, label[:31], 0))
+    fd = os.open(chip, os.O_RDONLY)
+    try:
+      fcntl.ioctl(fd, GPIO_GET_LINEEVENT_IOCTL, req, True)
+    finally:
+      os.close(fd)
+    self.fd = struct.unpack(GPIOEVENT_REQUEST, bytes(req))[-1]
+
+  def __repr__(self):
+    return 'line: %s:%d' % (self.chip, self.line)
+
+  def asserted(self):
+    values = bytearray(64)
+    fcntl.ioctl(self.fd, GPIOHANDLE_GET_LINE_VALUES_IOCTL, values, True)
+    return bool(values[0]) != self.active_low
+
+  def wait(self, timeout=None):
+    'Wait up to timeout seconds for the line, True if asserted'
+    if not self.asserted() and not select.select([self.fd], [], [], timeout)[0]:
+      return False
+    # drop the queued edges, the caller reads the state anyway
+    while select.select([self.fd], [], [], 0)[0]:
+      os.read(self.fd, struct.calcsize(GPIOEVENT_DATA))
+    return True
+
+  def close(self):
+    if self.fd is not None:
+      os.close(self.fd)
+      self.fd = None
@@ -0,0 +1,136 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: ts=2 sts=2 sw=2 et si
+#
+# Button events from button samples
+# by sdb
+#
+# The buttons are read as a state now and then (polled, or after an
+# interrupt).  Keypad turns those samples into timestamped press, release,
+# repeat and long press events, debounced, for the handlers to consume in
+# order instead of looking at the raw state.
+#
+# Open source. MIT license
+
+
+from collections import deque, namedtuple
+
+
+PRESS = 'press'
+RELEASE = 'release'
+REPEAT = 'repeat'
+LONG = 'long'
+
+DEBOUNCE = 0.02     # seconds a key ignores changes after one
+LONG_SECS = 1.0     # held this long is a long press
+REPEAT_DELAY = 0.5  # seconds held before the first repeat
+REPEAT_EVERY = 0.1  # seconds between repeats
+
+
+# held is how long the key was held, for release, repeat and long
+Event = namedtuple('Event', 'kind key time held')
+
+
+
+
+class Keypad(object):
+  '''
+  Events of a set of keys
+
+  sample(pressed, now) feeds a button state, tick(now) lets time pass
+  (for repeat, long press and a release that was held back by the
+  debounce), deadline() tells when it is next due.  Both queue the
+  events in events.  A key changing state within DEBOUNCE of its last
+  change is held back until then, so the first edge counts without
+  delay and a bouncing contact only once.
+
+  The first sample after start() is the baseline: keys already down
+  then (e.g. the one that started an applet) do nothing until pressed
+  again.  repeats are the keys that repeat while held alone, interval
+  (secs held) the time to the next repeat.
+  '''
+
+  def __init__(self, keys, repeats=(), interval=None, debounce=DEBOUNCE, long=LONG_SECS):
+    self.keys = list(keys)
+    self.repeats = frozenset(repeats)
+    self.interval = interval or (lambda secs: REPEAT_EVERY)
+    self.debounce = debounce
+    self.long = long
+    self.events = deque()
+    self.start()
+
+  def __repr__(self):
+    return 'keypad: %s' % ' '.join(str(k) for k in self.keys if self.down[k] is not None)
+
+  def start(self):
+    'Forget the state, the next sample is the baseline'
+    self.raw = dict((k, False) for k in self.keys)
+    self.down = dict((k, None) for k in self.keys)    # since when, None if up
+    self.changed = dict((k, None) for k in self.keys)
+    self.longs = set()
+    self.next_repeat = None
+    self.primed = False
+    self.events.clear()
+
+  def sample(self, pressed, now):
+    'pressed: the keys down at time now'
+    pressed = set(pressed)
+    for k in self.keys:
+      self.raw[k] = k in pressed
+    if not self.primed:
+      # the baseline, keys down now are ignored until released
+      self.primed = True
+      for k in pressed:
+        self.changed[k] = now
+        self.down[k] = False
+      return
+    self.tick(now)
+
+  def _edge(self, k, now):
+    since = self.down[k]
+    if self.raw[k]:
+      self.down[k] = now
+      self.events.append(Event(PRESS, k, now, 0))
+    else:
+      self.down[k] = None
+      self.longs.discard(k)
+      if since:
+        self.events.append(Event(RELEASE, k, now, now - since))
+    self.changed[k] = now
+    held = [k for k in self.keys if self.down[k]]
+    repeat = len(held) == 1 and held[0] in self.repeats
+    self.next_repeat = now + REPEAT_DELAY if repeat else None
+
+  def tick(self, now):
+    'Let time pass: held back edges, long presses, repeats'
+    for k in self.keys:
+      if self.raw[k] != (self.down[k] is not None):
+        if self.changed[k] is None or now - self.changed[k] >= self.debounce:
+          self._edge(k, now)
+    for k in self.keys:
+      since = self.down[k]
+      if since and k not in self.longs and now - since >= self.long:
+        self.longs.add(k)
+        self.events.append(Event(LONG, k, now, now - since))
+    if self.next_repeat is not None and now >= self.next_repeat:
+      k = [k for k in self.keys if self.down[k]][0]
+      held = now - self.down[k]
+      self.events.append(Event(REPEAT, k, now, held))
+      self.next_repeat = now + self.interval(held)
+
+  def deadline(self):
+    'When tick() has something to do, None if nothing but a sample can change'
+    due = []
+    for k in self.keys:
+      if self.raw[k] != (self.down[k] is not None) and self.changed[k] is not None:
+        due.append(self.changed[k] + self.debounce)
+      since = self.down[k]
+      if since and k not in self.longs:
+        due.append(since + self.long)
+    if self.next_repeat is not None:
+      due.append(self.next_repeat)
+    return min(due) if due else None
+
+  def get(self):
+    'The next event, None if there is none'
+    return self.events.popleft() if self.events else None
@@ -0,0 +1,224 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: ts=2 sts=2 sw=2 et si
+#
+# Counters and latency histograms of the radio
+# by sdb
+#
+# Where does the time go on a radio in the field?  The loop, the I2C bus
+# and the mpd commands count and time themselves into a Metrics, an
+# Exporter thread writes it as JSON to a file under /dev/shm (next to the
+# pid files of onlyone) every so often:
+#
+#   cat /dev/shm/radio.metrics.json
+#
+# Open source. MIT license
+
+
+import json
+import os
+import threading
+from clock import monotonic
+from collections import defaultdict
+from contextlib import contextmanager
+from time import time
+
+
+DEBUG = 0
+PATH = '/dev/shm/radio.metrics.json'
+EVERY = 10    # seconds between writes
+
+# upper bounds of the histogram buckets, seconds
+BOUNDS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)
+
+
+
+
+class Histogram(object):
+  ''' Counts of values (seconds) by bucket, with their sum and maximum '''
+
+  def __init__(self, bounds=BOUNDS):
+    self.bounds = bounds
+    self.buckets = [0] * (len(bounds) + 1)
+    self.count = 0
+    self.sum = 0.0
+    self.max = 0.0
+
+  def observe(self, value):
+    for i, bound in enumerate(self.bounds):
+      if value <= bound:
+        break
+    else:
+      i = len(self.bounds)
+    self.buckets[i] += 1
+    self.count += 1
+    self.sum += value
+    self.max = max(self.max, value)
+
+  def quantile(self, q):
+    'Upper bound of the bucket holding quantile q, None without values'
+    if not self.count:
+      return None
+    rank = q * self.count
+    seen = 0
+    for i, n in enumerate(self.buckets):
+      seen += n
+      if seen >= rank:
+        return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+    return self.max
+
+  def summary(self):
+    ms = lambda v: None if v is None else round(v * 1e3, 3)
+    buckets = dict(('le_%g' % (bound * 1e3), n) for bound, n in zip(self.bounds, self.buckets) if n)
+    if self.buckets[-1]:
+      buckets['inf'] = self.buckets[-1]
+    return {
+      'count': self.count,
+      'sum_ms': ms(self.sum),
+      'mean_ms': ms(self.sum / self.count) if self.count else None,
+      'p50_ms': ms(self.quantile(0.5)),
+      'p99_ms': ms(self.quantile(0.99)),
+      'max_ms': ms(self.max),
+      'buckets_ms': buckets,
+    }
+
+
+
+
+class Metrics(object):
+  '''
+  Named counters, histograms and values, from any thread
+
+  Names are dotted, the first part is the group: 'i2c.write_byte_data',
+  'mpd.status', 'frames.drawn', ...
+  '''
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.started = monotonic()
+    self.counters = defaultdict(int)
+    self.histograms = defaultdict(Histogram)
+    self.values = {}
+
+  def count(self, name, n=1):
+    with self.lock:
+      self.counters[name] += n
+
+  def once(self, name, value):
+    'Set the value of name unless it has one, True if it was set'
+    with self.lock:
+      if name in self.values:
+        return False
+      self.values[name] = value
+      return True
+
+  def observe(self, name, secs):
+    with self.lock:
+      self.histograms[name].observe(secs)
+
+  @contextmanager
+  def timed(self, name):
+    'Observe how long the with block takes'
+    start = monotonic()
+    try:
+      yield
+    finally:
+      self.observe(name, monotonic() - start)
+
+  def snapshot(self):
+    with self.lock:
+      return {
+        'time': time(),
+        'uptime': monotonic() - self.started,
+        'counters': dict(self.counters),
+        'values': dict(self.values),
+        'histograms': dict((name, h.summary()) for name, h in self.histograms.items()),
+      }
+
+  def write(self, path=PATH):
+    'Replace the file at path with a snapshot, readers never see half of one'
+    tmp = '%s.%d' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+      json.dump(self.snapshot(), f, indent=1, sort_keys=True, separators=(',', ': '))
+      f.write('\n')
+    os.rename(tmp, path)
+
+
+
+
+class MeteredBus(object):
+  '''
+  Wraps an smbus.SMBus, counts transactions and bytes (the register
+  address included, like fakebus) and times them, per method
+  '''
+
+  # method: bytes besides the data, index of the data argument or None
+  METHODS = {
+    'write_quick': (0, None),
+    'read_byte': (1, None),
+    'write_byte': (1, None),
+    'read_byte_data': (2, None),
+    'write_byte_data': (2, None),
+    'read_word_data': (3, None),
+    'write_word_data': (3, None),
+    'read_i2c_block_data': (1, 2),
+    'write_i2c_block_data': (1, 2),
+    'write_block_data': (2, 2),
+  }
+
+  def __init__(self, bus, metrics):
+    self._bus = bus
+    self._metrics = metrics
+
+  def __getattr__(self, name):
+    attr = getattr(self._bus, name)
+    if name not in self.METHODS:
+      return attr
+    fixed, data = self.METHODS[name]
+    metrics = self._metrics
+    def call(*args):
+      start = monotonic()
+      try:
+        return attr(*args)
+      finally:
+        size = fixed
+        if data is not None and len(args) > data:
+          arg = args[data]
+          size += arg if isinstance(arg, int) else len(arg)
+        elif name == 'read_i2c_block_data':
+          size += 32
+        metrics.observe('i2c.' + name, monotonic() - start)
+        metrics.count('i2c.bytes.' + name, size)
+    call.__name__ = name
+    return call
+
+
+
+
+class Exporter(threading.Thread):
+  ''' Writes the metrics to path every so many seconds '''
+
+  def __init__(self, metrics, path=PATH, every=EVERY):
+    super(Exporter, self).__init__(name='metrics')
+    self.daemon = True
+    self.metrics = metrics
+    self.path = path
+    self.every = every
+    self.stopped = threading.Event()
+
+  def run(self):
+    while not self.stopped.wait(self.every):
+      self.export()
+
+  def export(self):
+    try:
+      self.metrics.write(self.path)
+    except (IOError, OSError) as e:
+      if DEBUG: print 'metrics:', e
+
+  def stop(self):
+    'Stop, with a last write'
+    self.stopped.set()
+    if self.is_alive():
+      self.join()
+    self.export()
@@ -0,0 +1,355 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: ts=2 sts=2 sw=2 et si
+#
+# Minimal MPD protocol client
+# by sdb
+#
+# Keeps one connection to mpd open (TCP or unix socket) instead of
+# spawning an mpc process per command.  Only what the radio needs.
+#
+# Open source. MIT license
+
+
+import os
+import socket
+import threading
+
+
+DEBUG = 0
+DEFAULT_HOST = 'localhost'
+DEFAULT_PORT = 6600
+TIMEOUT = 10
+
+
+
+
+class MPDError(Exception):
+  pass
+
+
+class MPDConnectionError(MPDError):
+  pass
+
+
+class MPDCommandError(MPDError):
+  ''' mpd answered ACK [error@index] {command} message '''
+
+  def __init__(self, line):
+    super(MPDCommandError, self).__init__(line)
+    self.ack = line
+    try:
+      self.index = int(line.split('@', 1)[1].split(']', 1)[0])
+    except (IndexError, ValueError):
+      self.index = 0
+
+
+
+
+def quote(arg):
+  'Quote an argument for the mpd protocol'
+  arg = str(arg)
+  return '"%s"' % arg.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def todict(pairs):
+  'Convert a (key, value) response to a dict, last value wins'
+  return dict(pairs)
+
+
+
+
+class MPDClient(object):
+  '''
+  Persistent connection to mpd
+
+  host/port default like mpc: $MPD_HOST / $MPD_PORT, where MPD_HOST
+  may be 'password@host' and a host starting with '/' is a unix socket.
+  A dropped connection is re-established on the next command.
+  '''
+
+  def __init__(self, host=None, port=None, timeout=TIMEOUT):
+    host = host or os.environ.get('MPD_HOST') or DEFAULT_HOST
+    self.password = None
+    if '@' in host and not host.startswith('/'):
+      self.password, host = host.rsplit('@', 1)
+    self.host = host
+    self.port = int(port or os.environ.get('MPD_PORT') or DEFAULT_PORT)
+    self.timeout = timeout
+    self.version = None
+    self._sock = None
+    self._rfile = None
+
+  def __repr__(self):
+    return 'mpd: %s' % (self.host if self.host.startswith('/') else '%s:%d' % (self.host, self.port))
+
+
+  # ----------------------------------------------------------------------
+  # Connection
+
+  @property
+  def connected(self):
+    return self._sock is not None
+
+  def connect(self):
+    if self._sock:
+      return
+    try:
+      if self.host.startswith('/'):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.host)
+      else:
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+    except (socket.error, socket.timeout) as e:
+      raise MPDConnectionError('connect %r: %s' % (self, e))
+    self._sock = sock
+    self._rfile = sock.makefile('rb')
+    hello = self._readline()
+    if not hello.startswith('OK MPD '):
+      self.disconnect()
+      raise MPDConnectionError('not mpd: %r' % hello)
+    self.version = hello[7:]
+    if DEBUG: print 'connected', repr(self), self.version
+    if self.password:
+      self._execute(('password', self.password))
+
+  def disconnect(self):
+    for f in (self._rfile, self._sock):
+      try:
+        if f: f.close()
+      except (socket.error, IOError):
+        pass
+    self._sock = self._rfile = None
+
+  def clone(self, timeout=TIMEOUT):
+    'A new, unconnected client for the same server'
+    client = MPDClient(self.host, self.port, timeout)
+    client.password = self.password
+    return client
+
+
+  # ----------------------------------------------------------------------
+  # Protocol
+
+  def _writeline(self, line):
+    if DEBUG > 3: print 'mpd <', line
+    try:
+      self._sock.sendall(line + '\n')
+    except (socket.error, socket.timeout) as e:
+      self.disconnect()
+      raise MPDConnectionError('write: %s' % e)
+
+  def _readline(self):
+    try:
+      line = self._rfile.readline()
+    except (socket.error, socket.timeout) as e:
+      self.disconnect()
+      raise MPDConnectionError('read: %s' % e)
+    if not line.endswith('\n'):
+      self.disconnect()
+      raise MPDConnectionError('connection lost')
+    line = line[:-1]
+    if DEBUG > 3: print 'mpd >', line
+    return line
+
+  def _readpairs(self, end='OK'):
+    'Read key: value lines up to the end marker'
+    pairs = []
+    while True:
+      line = self._readline()
+      if line == end:
+        return pairs
+      if line.startswith('ACK '):
+        raise MPDCommandError(line)
+      key, sep, value = line.partition(': ')
+      if not sep:
+        self.disconnect()
+        raise MPDConnectionError('bad response: %r' % line)
+      pairs.append((key, value))
+
+  @staticmethod
+  def _format(cmd):
+    if isinstance(cmd, str):
+      return cmd
+    return ' '.join([cmd[0]] + [quote(a) for a in cmd[1:]])
+
+  def _execute(self, cmd):
+    self._writeline(self._format(cmd))
+    return self._readpairs()
+
+  def command(self, *cmd):
+    '''
+    Send one command and return its response as a list of (key, value)
+    Reconnects and retries once if the connection was dropped
+    '''
+    for retry in (True, False):
+      try:
+        self.connect()
+        return self._execute(cmd)
+      except MPDConnectionError:
+        if not retry:
+          raise
+        if DEBUG: print 'reconnect', repr(self)
+
+  def command_list(self, commands):
+    '''
+    Send several commands as one command_list_ok_begin ... command_list_end
+    round trip and return a list with the response of each command
+
+    On an ACK the MPDCommandError carries the responses of the commands
+    before the failing one in .results
+    '''
+    lines = ['command_list_ok_begin'] + [self._format(c) for c in commands] + ['command_list_end']
+    for retry in (True, False):
+      try:
+        self.connect()
+        self._writeline('\n'.join(lines))
+        results = []
+        try:
+          for cmd in commands:
+            results.append(self._readpairs('list_OK'))
+        except MPDCommandError as e:
+          e.results = results
+          raise
+        self._readpairs()
+        return results
+      except MPDConnectionError:
+        if not retry:
+          raise
+        if DEBUG: print 'reconnect', repr(self)
+
+
+  # ----------------------------------------------------------------------
+  # The operations the radio used mpc for
+
+  def status(self):
+    return todict(self.command('status'))
+
+  def currentsong(self):
+    return todict(self.command('currentsong'))
+
+  def clear(self):
+    self.command('clear')
+
+  def load(self, name):
+    self.command('load', name)
+
+  def play(self, pos=None):
+    if pos is None:
+      self.command('play')
+    else:
+      self.command('play', pos)
+
+  def stop(self):
+    self.command('stop')
+
+  def volume(self, vol=None):
+    '''
+    Without argument return the current volume (-1 if there is no mixer),
+    otherwise set it: an absolute value or a relative '+n' / '-n' like mpc
+    '''
+    if vol is None:
+      return int(self.status().get('volume', -1))
+    vol = str(vol)
+    if vol[0] in '+-':
+      vol = self.volume() + int(vol)
+    self.command('setvol', max(0, min(int(vol), 100)))
+
+  def current(self):
+    'The current song as a dict, empty if nothing is playing'
+    return self.currentsong()
+
+  def lsplaylists(self):
+    return [v for k, v in self.command('listplaylists') if k == 'playlist']
+
+
+  # ----------------------------------------------------------------------
+  # Change notification
+
+  def idle(self, *subsystems):
+    'Block until one of the subsystems changes, return the changed ones'
+    return [v for k, v in self.command('idle', *subsystems) if k == 'changed']
+
+  def noidle(self):
+    '''
+    Cancel a pending idle from another thread, the idling thread
+    reads the response
+    '''
+    if self._sock:
+      self._writeline('noidle')
+
+
+
+
+class IdleWatcher(threading.Thread):
+  '''
+  Runs mpd 'idle' on its own connection and passes the changed
+  subsystems to the subscribers
+
+  Callbacks run on the watcher thread as callback(changed, client) and
+  should use the given client for any queries.  After a lost connection
+  all subsystems are reported as changed.
+  '''
+
+  def __init__(self, client, subsystems=('player', 'mixer', 'playlist', 'stored_playlist'), retry=5):
+    super(IdleWatcher, self).__init__(name='mpd-idle')
+    self.daemon = True
+    self.client = client
+    self.subsystems = tuple(subsystems)
+    self.retry = retry
+    self._subs = []
+    self._quit = threading.Event()
+
+  def subscribe(self, callback, subsystems=None):
+    'Call callback on changes of subsystems (default: all watched)'
+    self._subs = self._subs + [(frozenset(subsystems or self.subsystems), callback)]
+    return self.is_alive()
+
+  def unsubscribe(self, callback):
+    self._subs = [s for s in self._subs if s[1] != callback]
+
+  def _notify(self, changed):
+    changed = frozenset(changed)
+    for subsystems, callback in self._subs:
+      if subsystems & changed:
+        try:
+          callback(changed, self.client)
+        except Exception as e:
+          print "Error: idle callback %r: %s" % (callback, e)
+
+  def run(self):
+    lost = False
+    while not self._quit.is_set():
+      try:
+        if lost:
+          self.client.connect()
+          lost = False
+          self._notify(self.subsystems)
+        changed = self.client.idle(*self.subsystems)
+      except MPDError as e:
+        if self._quit.is_set():
+          break
+        if DEBUG: print 'idle:', e
+        lost = not self.client.connected
+        self._quit.wait(self.retry)
+        continue
+      if changed:
+        self._notify(changed)
+    self.client.disconnect()
+
+  def stop(self):
+    self._quit.set()
+    try:
+      self.client.noidle()
+    except MPDError:
+      pass
+
+
+
+
+if __name__ == '__main__':
+  import sys
+  client = MPDClient()
+  for pair in client.command(*(sys.argv[1:] or ['status'])):
+    print '%s: %s' % pair
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim: ts=2 sts=2 sw=2 et si
+#
+# Profiling the running radio
+# by sdb
+#
+# The radio is sluggish, where does the loop thread spend its time?  Send
+# it a signal and it profiles itself for a while:
+#
+#   kill -USR1 $(cat /dev/shm/radio.py.pid)   # stack samples
+#   kill -USR2 $(cat /dev/shm/radio.py.pid)   # cProfile, slows it down
+#
+# or start with RADIO_PROFILE=sample (or cprofile) in the environment.
+# After RADIO_PROFILE_SECS (30) seconds, or the same signal again, the
+# result is written to /dev/shm: radio-<pid>-<time>.folded, collapsed
+# stacks for flamegraph.pl, or radio-<pid>-<time>.pstats for pstats.
+#
+# Open source. MIT license
+
+
+import cProfile
+import os
+import sys
+import threading
+from collections import defaultdict
+from time import strftime
+
+
+DEBUG = 0
+PATH = '/dev/shm'
+SECS = 30         # the profiling window
+INTERVAL = 0.005  # seconds between stack samples
+
+SAMPLE = 'sample'
+CPROFILE = 'cprofile'
+
+
+
+
+class Sampler(threading.Thread):
+  ''' Samples the stack of a thread (ident) every interval seconds '''
+
+  def __init__(self, thread, interval=INTERVAL):
+    super(Sampler, self).__init__(name='sampler')
+    self.daemon = True
+    self.thread = thread
+    self.interval = interval
+    self.stacks = defaultdict(int)
+    self.stopped = threading.Event()
+
+  def run(self):
+    while not self.stopped.wait(self.interval):
+      frame = sys._current_frames().get(self.thread)
+      stack = []
+      while frame is not None:
+        code = frame.f_code
+        stack.append('%s:%s' % (os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+      if stack:
+        self.stacks[';'.join(reversed(stack))] += 1
+
+  def stop(self):
+    self.stopped.set()
+    self.join()
+
+  def write(self, path):
+    with open(path, 'w') as f:
+      for stack, n in sorted(self.stacks.items()):
+        f.write('%s %d\n' % (stack, n))
+
+
+
+
+class Profiler(object):
+  '''
+  Profiles the thread of loop for a window of secs seconds
+
+  toggle(mode) starts or ends a window, from any thread or a signal
+  handler: the work is done on the loop thread.
+  '''
+
+  def __init__(self, loop, path=PATH, secs=SECS):
+    self.loop = loop
+    self.path = path
+    self.secs = secs
+    self.mode = None
+    self.window = None
+
+  def toggle(self, mode=SAMPLE):
+    self.loop.call_soon(self._toggle, mode)
+
+  def _toggle(self, mode):
+    if self.mode is None:
+      self.start(mode)
+    elif self.mode == mode:
+      self.stop()
+
+  def start(self, mode=SAMPLE):
+    'Profile from now on, on the loop thread'
+    if self.mode is not None:
+      return
+    if mode == CPROFILE:
+      self.profile = cProfile.Profile()
+      self.profile.enable()
+    else:
+      self.profile = Sampler(threading.current_thread().ident)
+      self.profile.start()
+    self.mode = mode
+    self.window = threading.Timer(self.secs, self.loop.call_soon, (self.stop,))
+    self.window.daemon = True
+    self.window.start()
+    print 'profiling (%s) for %gs' % (mode, self.secs)
+
+  def stop(self):
+    'Stop profiling and write the result, on the loop thread'
+    if self.mode is None:
+      return
+    self.window.cancel()
+    name = os.path.join(self.path, 'radio-%d-%s' % (os.getpid(), strftime('%Y%m%d%H%M%S')))
+    try:
+      if self.mode == CPROFILE:
+        self.profile.disable()
+        name += '.pstats'
+        self.profile.dump_stats(name)
+      else:
+        self.profile.stop()
+        name += '.folded'
+        self.profile.write(name)
+      print 'profile written to', name
+    except (IOError, OSError) as e:
+      print "Error: %s\nProfile: %s" % (str(e), name)
+    self.mode = self.profile = self.window = None
+
+  def fromenv(self, environ=os.environ):
+    'Start profiling as RADIO_PROFILE and RADIO_PROFILE_SECS say'
+    mode = environ.get('RADIO_PROFILE')
+    if mode:
+      self.secs = float(environ.get('RADIO_PROFILE_SECS', self.secs))
+      self.toggle(CPROFILE if mode == CPROFILE else SAMPLE)
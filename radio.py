@@ -14,9 +14,18 @@
 # The basic navigation code is based on lcdmenu.py by Alan Aufderheide
 
 
-import Adafruit_CharLCD as LCD
+import Adafruit_CharLCDPlate as LCD
+import bisect
+import eventloop
+import keypad
+import metrics
+import mpdclient
+import os
+import profiler
 import subprocess
 import signal
+from array import array
+from clock import monotonic
 from time import strftime, sleep
 try:
 	from unidecode import unidecode
@@ -25,9 +34,29 @@ except ImportError:
 
 
 DEBUG = 0
-IDLE_SECS = 180
+IDLE_SECS = 180     # without a key the backlight goes off (dimmed)
+SLEEP_SECS = 600    # and then the display too (sleep)
+SLEEP_POLL = 0.5    # seconds between button reads in sleep, changes are latched
+READ_RETRY = 0.1    # a failed button read is tried again after this,
+READ_RETRY_MAX = 5  # twice as long each time it fails again
+REPEAT_FAST = 0.05  # shortest up/down repeat interval, reached after about 2s
+JUMP_SECS = 2.5     # held this long a menu jumps by initial letter,
+JUMP_EVERY = 0.5    # once every so many seconds
+SCROLL_SECS = 0.4   # a long line scrolls a column every so often,
+SCROLL_PAUSE = 1.4  # stops this long at either end
+UPDATE_SECS = 2     # now playing is asked for this often without idle
+VOLUME_SETTLE = 0.3 # volume steps this close together are sent as one
+VOLUME_SHOW = 2     # seconds a volume change is shown
+PLAYLIST_DIR = '/var/lib/mpd/playlists'
 TIME_FORMAT = '%Y.%m.%d %H:%M:%S'
 
+STARTED = monotonic() # boot times are since radio.py was loaded
+
+# power states
+NORMAL = 'normal'
+DIMMED = 'dimmed'
+SLEEP = 'sleep'
+
 
 
 
@@ -83,6 +112,36 @@ class Node(BaseNode):
 
 
 
+class Later(Node):
+  '''
+  A Node whose call is slow (a command): it runs on the 'proc' executor
+  of loop, the text is waiting until it is done and app shows it then
+  '''
+  waiting = '...'
+
+  def __init__(self, app, loop, **kwargs):
+    self.app = app
+    self.loop = loop
+    super(Later, self).__init__(**kwargs)
+
+  def _docall(self):
+    if self.call:
+      self.text = self.waiting
+      self.loop.then(self.loop.run_in_executor('proc', self._call), self._done)
+
+  def _call(self):
+    try:
+      return self.call()
+    except Exception as e:
+      return 'callerr: ' + str(e)
+
+  def _done(self, text):
+    self.text = text
+    if self.app.running and self.app.power != SLEEP:
+      self.app.display()
+
+
+
 class Timer(BaseNode):
   mark = '-'
 
@@ -118,21 +177,236 @@ class Folder(Node):
 
   def setItems(self, items):
     self.items = items
-    for item in self.items:
-      item.parent = self
+    if isinstance(items, Items):
+      items.parent = self
+      texts = (items.name(i) for i in range(len(items)))
+    else:
+      for item in self.items:
+        item.parent = self
+      texts = (item.text for item in self.items)
+    self.initials = initials(texts)
+
+
+
+def initials(texts):
+  '''
+  Indices where the initial letter changes, the jump targets when
+  holding up/down in a long (sorted) list
+  '''
+  starts = []
+  last = None
+  for i, text in enumerate(texts):
+    initial = text[:1].upper()
+    if initial != last:
+      starts.append(i)
+      last = initial
+  return starts
+
+
+
+class Items(object):
+  '''
+  Folder items made from names only when looked at
+
+  The names are kept in one string with an array of offsets.  An item is
+  made by make(name) when its row is shown, together with prefetch rows
+  around it, and only the rows near the last one shown are kept.  So a
+  folder of thousands of names costs little more than the names and a
+  keypress the same as with a few.
+  '''
+
+  def __init__(self, names, make, prefetch=4, keep=16):
+    offsets = array('L', [0])
+    for name in names:
+      offsets.append(offsets[-1] + len(name))
+    self._names = ''.join(names)
+    self._offsets = offsets
+    self._make = make
+    self._cache = {}
+    self.prefetch = prefetch
+    self.keep = keep
+    self.parent = None
+
+  def __repr__(self):
+    return 'items: %d, %d made' % (len(self), len(self._cache))
+
+  def __len__(self):
+    return len(self._offsets) - 1
+
+  def name(self, i):
+    return self._names[self._offsets[i]:self._offsets[i + 1]]
+
+  def _item(self, i):
+    item = self._cache.get(i)
+    if item is None:
+      item = self._cache[i] = self._make(self.name(i))
+      item.parent = self.parent
+    return item
+
+  def __getitem__(self, i):
+    n = len(self)
+    if not -n <= i < n:
+      raise IndexError('item index out of range')
+    i %= n
+    item = self._cache.get(i)
+    if item is None:
+      if len(self._cache) > 2 * self.keep:
+        # forget what is far from here, around the end too
+        for j in self._cache.keys():
+          if min((i - j) % n, (j - i) % n) > self.keep:
+            del self._cache[j]
+      for j in range(i - self.prefetch, i + self.prefetch + 1):
+        self._item(j % n)
+      item = self._cache[i]
+    return item
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
+
+  def index(self, item):
+    for i, made in self._cache.items():
+      if made is item:
+        return i
+    # names are looked up by text, binary search if they are sorted
+    text = getattr(item, 'text', None)
+    i = bisect.bisect_left(_Names(self), text)
+    if i < len(self) and self.name(i) == text:
+      return i
+    for i in range(len(self)):
+      if self.name(i) == text:
+        return i
+    raise ValueError('%r is not in items' % (item,))
+
+
+class _Names(object):
+  ''' the names of Items as a sequence, for bisect '''
+  def __init__(self, items):
+    self.items = items
+  def __len__(self):
+    return len(self.items)
+  def __getitem__(self, i):
+    return self.items.name(i)
 
 
 
 class Playlists(Folder):
-  def __init__(self, radio, wrap=True, **kwargs):
+  '''
+  The stored playlists of mpd, kept until mpd reports a stored_playlist
+  change or the mtime of the playlist directory changes
+
+  With preload all of them are loaded into the queue once they are
+  known (again only when their names change), positions has where each
+  starts: a station is then just a 'play pos' away.  Until then (or if
+  loading fails) a station is loaded when it is played.  mpd plays
+  single songs, so a stream that ends does not move on to the next
+  station, restore() puts its option back.
+  '''
+
+  def __init__(self, radio, wrap=True, directory=PLAYLIST_DIR, preload=True, **kwargs):
     self.radio = radio
+    self.directory = directory
+    self.preload = preload
+    self.positions = None
+    self.queued = None
+    self.single = None
+    self.station = None
+    self.mtime = None
+    self.stale = True
+    self.fetching = False
     super(Playlists, self).__init__(text='Playlists', wrap=wrap, **kwargs)
 
+  def _dirtime(self):
+    try:
+      return os.stat(self.directory).st_mtime
+    except OSError:
+      return None
+
   def into(self):
     if DEBUG: print "into", repr(self)
-    self.setItems([
-      Playlist(playlist, self.radio) for playlist in sorted(self.radio.mpccommand('lsplaylists'))
-    ])
+    if self.stale or self._dirtime() != self.mtime:
+      self.refresh()
+    if not self.items:
+      self.setItems([Node(text='Loading...')])
+
+  def refresh(self):
+    ''' fetch the playlists in the background '''
+    self.stale = True
+    if self.fetching:
+      return
+    self.stale = False
+    self.fetching = True
+    self.mtime = self._dirtime()
+    self.radio.loop.then(self.radio.mpccommand('lsplaylists'), self._loaded)
+
+  def _changed(self, changed, client):
+    ''' idle watcher callback, runs on the watcher thread '''
+    self.radio.loop.call_soon(self.refresh)
+
+  def _loaded(self, playlists):
+    self.fetching = False
+    if playlists is None:
+      self.stale = True
+      return
+    if self.stale:
+      # changed again meanwhile
+      self.refresh()
+    names = sorted(playlists)
+    self.setItems(
+      Items(names, lambda name: Playlist(name, self.radio))
+      if playlists else [Node(text='No playlists')])
+    if self.preload and playlists and names != self.queued:
+      self.load(names)
+    if self.radio.folder is self:
+      self.radio.selected = min(self.radio.selected, len(self.items) - 1)
+      self.radio.top = min(self.radio.top, self.radio.selected)
+      if self.radio.running:
+        self.radio.display()
+
+
+
+  def load(self, names):
+    '''
+    the playlists into the queue, each followed by the queue length,
+    after the status (was a station playing, the single option)
+    '''
+    self.positions = None
+    self.queued = names
+    cmds = [('status',), ('clear',)]
+    for name in names:
+      cmds += [('load', name), ('status',)]
+    cmds += [('single', '1')]
+    self.radio.loop.then(self.radio.mpclist(cmds), lambda results: self._queued(names, results))
+
+  def restore(self):
+    ''' put back the single option of mpd from before load() '''
+    if self.single is not None:
+      self.radio.mpclist([('single', self.single)])
+      self.single = None
+
+  def _queued(self, names, results):
+    if results is None:
+      self.queued = None
+      return
+    before = mpdclient.todict(results[0])
+    if self.single is None:
+      self.single = before.get('single')
+    positions = {}
+    pos = 0
+    for name, status in zip(names, results[3::2]):
+      length = int(mpdclient.todict(status).get('playlistlength', pos))
+      if length > pos:
+        positions[name] = pos
+      pos = length
+    self.positions = positions
+    if DEBUG: print 'queued:', len(positions), 'stations,', pos, 'streams'
+    if before.get('state') != 'play':
+      return
+    # the clear stopped it, play on
+    if self.radio.playing:
+      self.radio.playing.tune()
+    elif self.station in positions:
+      self.radio.transport((('play', positions[self.station]),))
 
 
 
@@ -141,16 +415,24 @@ class FinishException(Exception):
 
 
 
-ticks = 0
 class App(BaseNode):
   '''
   Base class of applications and applets
   '''
   ROWS = 2
   COLS = 16
+  kbpoll = 0.033
 
-  def __init__(self, lcd, folder, **kwargs):
+  def __init__(self, lcd, folder, mpd=None, watcher=None, loop=None, **kwargs):
+    self.loop = loop or eventloop.EventLoop()
+    self.metrics = self.loop.metrics
     self.lcd = lcd
+    self.mpd = mpd or mpdclient.MPDClient()
+    self.watcher = watcher
+    self.interrupt = getattr(lcd, 'interrupt', None)
+    self.canframe = hasattr(lcd, 'frame')
+    self.ddramcols = getattr(lcd, 'DDRAM_WIDTH', 0) if self.canframe else 0
+    self.running = False
     self.folder = folder
     self.top = 0
     self.selected = 0
@@ -162,10 +444,13 @@ class App(BaseNode):
       LCD.RIGHT: self.right,
       LCD.SELECT: self.select
     }
-    self.press_at = self.ticks
-    self.idle_secs = 10*IDLE_SECS
+    self.keypad = keypad.Keypad(self.buttonfuncs.keys(),
+      repeats=(LCD.UP, LCD.DOWN), interval=self.repeat_interval)
+    self.press_at = monotonic()
+    self.idle_secs = IDLE_SECS
+    self.sleep_secs = SLEEP_SECS
     self.lcd.set_backlight(1)
-    self.backlight = True
+    self.power = NORMAL
 
 
   def left(self):
@@ -184,6 +469,22 @@ class App(BaseNode):
     return
 
 
+  def release(self, key):
+    return
+
+  def long(self, key):
+    ''' key held for keypad.LONG_SECS '''
+    return
+
+  def repeat(self, key, secs):
+    ''' up/down still held alone after secs, by default it repeats '''
+    self.buttonfuncs[key]()
+
+  def repeat_interval(self, secs):
+    ''' seconds to the next repeat when held for secs '''
+    return max(REPEAT_FAST, 0.2 / (1 + 2 * (secs - keypad.REPEAT_DELAY)))
+
+
   def msg2line(self, msg):
     'Truncate and pad msg to length'
     return (msg + ' '*self.COLS)[:self.COLS]
@@ -208,14 +509,34 @@ class App(BaseNode):
       msg.append(self.msg2line(mark + self.folder.items[row].texttrunc(cols)))
     return msg
 
+  def render(self, msg, shift=None):
+    '''
+    Put the rows of msg on the lcd, only the changes if it can,
+    with the display shifted to shift (see Playlist.marquee)
+    '''
+    self.metrics.count('frames.drawn')
+    if self.canframe:
+      drawn = self.lcd.frame(msg, shift)
+    else:
+      self.lcd.home()
+      drawn = self.lcd.message('\n'.join(msg))
+    if 'boot.first_frame' not in self.metrics.values:
+      self.loop.then(drawn, lambda result: self.booted('boot.first_frame'))
+
+  def booted(self, name):
+    ''' a boot stage is done, the first time: how long it took '''
+    if self.metrics.once(name, monotonic() - STARTED):
+      if DEBUG: print '%s: %.3fs' % (name, self.metrics.values[name])
+
   def display(self):
     msg = self.msglist()
     if msg != self.lastmsg:
       self.lastmsg = msg
       if DEBUG:
         self.debugmsg(self.lastmsg)
-      self.lcd.home()
-      self.lcd.message('\n'.join(self.lastmsg))
+      self.render(self.lastmsg)
+    else:
+      self.metrics.count('frames.skipped')
 
 
   def command(self, cmd):
@@ -230,67 +551,263 @@ class App(BaseNode):
     if DEBUG > 3: print cmd, '-->', result
     return result
 
+  def _mpccommand(self, incmd):
+    cmd = [incmd] if isinstance(incmd, str) else list(incmd)
+    if DEBUG > 2: print DEBUG,cmd
+    try:
+      with self.metrics.timed('mpd.' + cmd[0]):
+        result = getattr(self.mpd, cmd[0])(*cmd[1:])
+    except mpdclient.MPDError as e:
+      print "Error: %s\nCommand: %s" % (str(e), cmd)
+      self.metrics.count('mpd.errors')
+      result = None
+    if DEBUG > 3: print cmd, '-->', result
+    return result
+
   def mpccommand(self, incmd):
-    cmd = ['mpc']
-    if isinstance(incmd, str):
-      cmd.append(incmd)
-    else:
-      cmd.extend(incmd)
-    return self.command(cmd)
+    '''
+    Run an mpc style command ('play', ['volume', '70'], ...) over the
+    persistent mpd connection on the mpd executor, returns a Future
+    '''
+    return self.loop.run_in_executor('mpd', self._mpccommand, incmd)
 
+  def _mpclist(self, cmds):
+    if DEBUG > 2: print DEBUG,cmds
+    try:
+      with self.metrics.timed('mpd.command_list'):
+        result = self.mpd.command_list(cmds)
+    except mpdclient.MPDError as e:
+      print "Error: %s\nCommands: %s" % (str(e), cmds)
+      self.metrics.count('mpd.errors')
+      result = None
+    if DEBUG > 3: print cmds, '-->', result
+    return result
+
+  def mpclist(self, cmds):
+    '''
+    Run raw mpd commands as one command list round trip, returns a Future
+    of the response of each or None on error
+    '''
+    return self.loop.run_in_executor('mpd', self._mpclist, cmds)
+
+  def transport(self, cmds, slot='transport'):
+    '''
+    mpclist() for what is played (load, play, stop, ...): a call still
+    waiting for the mpd executor is superseded by the next one for the
+    same slot, so of quick presses only the last one gets to mpd.  The
+    Future of a superseded one is cancelled.
+    '''
+    return self.loop.run_latest('mpd', slot, self._mpclist, cmds)
 
-  @property
-  def ticks(self):
-    ''' number of 1/10 seconds to have elapsed '''
-    return ticks
 
   def tick(self):
-    ''' each 1/10s 'tick' through the main run loop '''
-    global ticks
-    if not ticks % 10:
-      self.display()
-      if ticks - self.press_at > self.idle_secs:
-        self.lcd.set_backlight(0)
-        self.backlight = False
-    ticks += 1
+    ''' each second while awake: the display and the idle time '''
+    self.display()
+    idle = monotonic() - self.press_at
+    if self.power == NORMAL and idle > self.idle_secs:
+      self.setpower(DIMMED)
+    elif self.power == DIMMED and idle > self.sleep_secs:
+      self.setpower(SLEEP)
 
 
-  def run(self):
+  def every(self, secs, fn):
+    ''' call fn every secs seconds of this run, except in sleep '''
+    self.periodic.append([secs, fn, self.loop.call_every(secs, fn)])
+
+
+  def setpower(self, state):
     '''
-    Basic event loop of the application
+    normal: all on; dimmed: backlight off; sleep: display off as well,
+    no periodic calls (so no display updates) and the buttons read less
+    often, their changes latched in between
     '''
-    if DEBUG: print 'start:', self.folder
+    if state == self.power:
+      return
+    if DEBUG: print 'power:', self.power, '->', state
+    if self.power == SLEEP:
+      self.lcd.latch(False)
+      self.lcd.enable_display(True)
+      for p in self.periodic:
+        p[2] = self.loop.call_every(p[0], p[1])
+    if state == NORMAL:
+      self.lcd.set_backlight(1)
+    elif self.power == NORMAL:
+      self.lcd.set_backlight(0)
+    if state == SLEEP:
+      self.lcd.enable_display(False)
+      self.lcd.latch(True)
+      for p in self.periodic:
+        p[2].cancel()
+    self.power = state
+
+
+  def pollsecs(self):
+    ''' seconds to the next poll '''
+    return SLEEP_POLL if self.power == SLEEP else self.kbpoll
+
+
+  def read(self):
+    ''' ask for the buttons, wait for an interrupt if it can '''
+    if self.reader:
+      self.reader.cancel()
+      self.reader = None
+    if self._reading or not self.running:
+      return
+    self._reading = True
+    if self.interrupt and self.keypad.primed:
+      # wait for the INT line off the bus, read only after a change
+      wait = 2 if self.power == SLEEP else 0.5
+      self.loop.then(self.loop.run_in_executor('input', self.interrupt.wait, wait), self._interrupted, self._unread)
+    elif self.power == SLEEP and self.keypad.primed:
+      # only the changes since the last read, see setpower()
+      self.loop.then(self.lcd.readLatched(), self._captured, self._unread)
+    else:
+      self.loop.then(self.lcd.read_buttons(self.keypad.keys), self._polled, self._unread)
 
-    kbpoll = 0.033
-    ratio10ths = int(0.1/kbpoll)
-    uticks = 0
-    last_buttons = None
 
-    while True:
+  def _unread(self, e):
+    ''' a read failed: try again in a while, longer while it keeps failing '''
+    self._reading = False
+    self.metrics.count('input.errors')
+    self.readretry = min(self.readretry * 2, READ_RETRY_MAX) if self.readretry else READ_RETRY
+    if self.running:
+      self.reader = self.loop.call_later(self.readretry, self.read)
 
-      if self.backlight and not uticks % ratio10ths:
-        self.tick()
-        uticks = 0
-      uticks += 1
 
-      buttons = self.lcd.read_buttons(self.buttonfuncs.keys())
+  def _polled(self, buttons):
+    self._reading = False
+    self.readretry = 0
+    self.buttons(buttons)
+    if self.running:
+      self.reader = self.loop.call_later(self.pollsecs(), self.read)
 
-      if last_buttons == buttons:
-        sleep(kbpoll)
-        continue
 
-      last_buttons = buttons
-      self.press_at = self.ticks
-      if not self.backlight:
-        self.lcd.set_backlight(1)
-        self.backlight = True
+  def _interrupted(self, changed):
+    if changed:
+      # read even if no longer running, that clears the interrupt
+      self.loop.then(self.lcd.readInterrupt(), self._captured, self._unread)
+    else:
+      self._reading = False
+      self.read()
+
+
+  def _captured(self, states):
+    self._reading = False
+    self.readretry = 0
+    keys = self.keypad.keys
+    for state in states:
+      self.buttons([bool((state >> k) & 1) for k in keys])
+    if self.interrupt:
+      self.read()
+    elif self.running:
+      self.reader = self.loop.call_later(self.pollsecs(), self.read)
+
+
+  def buttons(self, buttons):
+    ''' a button state, a list in keypad.keys order '''
+    if not self.running:
+      return
+    self.keypad.sample([k for b,k in enumerate(self.keypad.keys) if buttons[b]], monotonic())
+    if 'boot.interactive' not in self.metrics.values:
+      self.booted('boot.interactive')
+    self.handle()
+    self.keytime()
+
+
+  def keytick(self):
+    self.keytimer = None
+    self.keypad.tick(monotonic())
+    self.handle()
+    self.keytime()
+
+
+  def keytime(self):
+    ''' have keytick() called when the keypad is due (repeat, long press, ...) '''
+    if not self.running:
+      return
+    if self.keytimer:
+      self.keytimer.cancel()
+    due = self.keypad.deadline()
+    self.keytimer = None if due is None else \
+      self.loop.call_later(max(0, due - monotonic()), self.keytick)
 
-      try:
-        buttons = [self.buttonfuncs[k]() for b,k in enumerate(self.buttonfuncs.keys()) if buttons[b]]
-      except FinishException:
-        break
 
+  def handle(self):
+    ''' run the handlers of the queued button events '''
+    event = self.keypad.get()
+    if event is None:
+      return
+
+    self.press_at = monotonic()
+    if self.power == SLEEP:
+      # only wake, the key does nothing (until pressed again)
+      self.setpower(NORMAL)
+      self.keypad.start()
+      self.invalidatedisplay()
       self.display()
+      return
+    self.setpower(NORMAL)
+
+    while event:
+      if DEBUG > 1: print 'event:', event
+      if event.kind == keypad.PRESS:
+        self.buttonfuncs[event.key]()
+      elif event.kind == keypad.RELEASE:
+        self.release(event.key)
+      elif event.kind == keypad.REPEAT:
+        self.repeat(event.key, event.held)
+      elif event.kind == keypad.LONG:
+        self.long(event.key)
+      event = self.keypad.get()
+
+    self.display()
+
+
+  def runapplet(self, applet):
+    ''' run applet, this app takes no keys until it is done '''
+    self.running = False
+    try:
+      applet.run()
+    finally:
+      self.running = True
+    if applet.power != self.power:
+      # the applet dimmed or slept the display, put it back
+      self.lcd.latch(self.power == SLEEP)
+      self.lcd.enable_display(self.power != SLEEP)
+      self.lcd.set_backlight(1 if self.power == NORMAL else 0)
+    self.press_at = monotonic()
+    self.invalidatedisplay()
+    self.keypad.start()
+    self.keytime()
+    self.read()
+
+
+  def start(self):
+    ''' first thing in the loop of the run: its timers, the buttons, the display '''
+    self.periodic = []
+    self.keytimer = None
+    self.reader = None
+    self.every(1, self.tick)
+    self.read()
+    self.display()
+
+
+  def run(self):
+    '''
+    Basic event loop of the application
+    '''
+    if DEBUG: print 'start:', self.folder
+
+    self._reading = False
+    self.readretry = 0
+    self.keypad.start()
+    self.running = True
+    try:
+      self.loop.run(self.start)
+    except FinishException:
+      pass
+    finally:
+      self.running = False
 
     if DEBUG: print 'finish:', self.folder
 
@@ -302,25 +819,46 @@ class Applet(App):
 
   def __init__(self, text, app, **kwargs):
     self.text = text
-    super(Applet, self).__init__(app.lcd, None, **kwargs)
+    super(Applet, self).__init__(app.lcd, None, mpd=app.mpd, watcher=app.watcher, loop=app.loop, **kwargs)
 
-  def left(self):
-    '''Return from applet'''
-    while True:
-      buttons = self.lcd.read_buttons(self.buttonfuncs.keys())
-      if not sum(buttons):
-        raise FinishException
-      if DEBUG > 1: print 'return holding:',buttons
-      sleep(0.01)
+  def release(self, key):
+    '''Return from applet when left is let go'''
+    if key == LCD.LEFT:
+      raise FinishException
 
 
 
 class Playlist(Applet):
+  '''
+  Plays a station: up/down the volume, select play/stop, right/left the
+  next/previous station of the folder, a long left returns
+  '''
   volumes = (0, 10, 40, 60, 70, 80, 85, 90, 95, 100)
 
+  def __init__(self, text, app):
+    # set up as an applet when run, like RGB
+    self.text = text
+    self.app = app
+
   def select(self):
     self.play = not self.play
-    self.mpccommand('play' if self.play else 'stop')
+    # after a tune still on its way, not instead of it
+    self.transport((('play',) if self.play else ('stop',),), 'playstop')
+
+
+  def right(self):
+    self.tune(self.index + 1)
+
+
+  def release(self, key):
+    ''' a short left is the previous station '''
+    if key == LCD.LEFT:
+      self.tune(self.index - 1)
+
+
+  def long(self, key):
+    if key == LCD.LEFT:
+      raise FinishException
 
 
   def up(self):
@@ -344,82 +882,262 @@ class Playlist(Applet):
 
 
   def _setvolume(self, index):
+    '''
+    Show the new volume now, send it once the steps settle: the local
+    volume stands until mpd has it
+    '''
     try:
-      vol = str(self.volumes[max(min(index, len(self.volumes)-1), 0)])
+      self.volume = self.volumes[max(min(index, len(self.volumes)-1), 0)]
     except (ValueError,TypeError,IndexError):
-      vol = str(index)
-    self.mpccommand(['volume', vol])
+      self.volume = index
+    self.note = '{volume: %d%%}' % self.volume
+    for timer in (self.volumer, self.noter):
+      if timer:
+        timer.cancel()
+    self.volumer = self.loop.call_later(VOLUME_SETTLE, self._sendvolume)
+    self.noter = self.loop.call_later(VOLUME_SHOW, self._endnote)
 
 
-  def update(self):
-    try:
-      self.volume = int(self.mpccommand('volume')[0].split(':')[1][:-1])
-      res = self.mpccommand(['-f', '%name%\n%title%', 'current'])
-      res.extend(['']*self.ROWS)
-      self.lines[0] = unidecode(res[0].split(',', 1)[0]) or '{%s}'%self.text
-      self.lines[1] = unidecode(res[1]) or '{volume: %d%%}'%self.volume
-    except:
+  def _sendvolume(self):
+    self.volumer = None
+    self.volumeset = self.loop.run_latest('mpd', 'volume', self._mpccommand, ['volume', str(self.volume)])
+
+
+  def _endnote(self):
+    self.noter = None
+    self.note = None
+    self.display()
+
+
+  def _parse(self, status, song):
+    '(name, title, volume) of what is playing'
+    return song.get('Name', '').split(',', 1)[0], song.get('Title', ''), int(status.get('volume', -1))
+
+
+  def _fetch(self, query):
+    return self._parse(query('status'), query('current'))
+
+
+  def _show(self, nowplaying):
+    name, title, volume = nowplaying
+    if not (self.volumer or self.volumepending or (self.volumeset and not self.volumeset.done())):
+      # no change of ours on the way
+      self.volume = volume
+    self.lines[0] = unidecode(name) or '{%s}'%self.station
+    self.lines[1] = unidecode(title) or '{volume: %d%%}'%self.volume
+
+
+  def _changed(self, changed, client):
+    ''' idle watcher callback, runs on the watcher thread '''
+    if DEBUG: print 'changed:', ' '.join(changed)
+    if self.power == SLEEP:
+      # nobody is looking, fetch it on wake
+      self.missed = True
+      return
+    self.loop.call_soon(self._pushed, self._fetch(lambda cmd: getattr(client, cmd)()))
+
+
+  def _pushed(self, nowplaying):
+    ''' new now playing info, show it right away '''
+    if not self.running:
+      return
+    lines = list(self.lines)
+    if nowplaying is None:
       self.lines[0] = 'Update failed'
       self.lines[1] = strftime(TIME_FORMAT)[1-self.COLS:]
+    else:
+      self._show(nowplaying)
+    if self.lines == lines and self.scroller:
+      # nothing new, scroll on as before
+      self.display()
+      return
+    self._rewind()
+    self.rescroll()
 
 
-  def display(self):
-    ticks = self.ticks
-    if DEBUG > 9: print ticks - self.lastdisp
-    if 3 >= ticks - self.lastdisp >= 0:
-      return
-    if DEBUG > 1: print ticks - self.lastdisp
-    self.lastdisp = ticks
+  def _update(self):
+    try:
+      return self._fetch(self._mpccommand)
+    except Exception:
+      return None
 
-    msg = [self.msg2line(l[self.rpos[n]:]) for n,l in enumerate(self.lines)]
+  def update(self):
+    self.loop.then(self.loop.run_in_executor('mpd', self._update), self._pushed)
+
+
+  def _rewind(self):
+    for r in range(self.ROWS):
+      if self.rpos[r] + self.COLS > len(self.lines[r]):
+        self.rdir[r] = 'L'
+        self.rpos[r] = 0
+
+
+  def display(self):
+    msg = self.marquee()
+    if self.note:
+      msg[-1] = self.msg2line(self.note)
     if msg != self.lastmsg:
       self.lastmsg = msg
       if DEBUG:
         if DEBUG > 2:
           self.debugmsg(self.lines)
         self.debugmsg(self.lastmsg)
-      self.lcd.home()
-      self.lcd.message('\n'.join(self.lastmsg))
+      self.render(self.lastmsg, self.hshift if self.ddramcols else None)
+    else:
+      self.metrics.count('frames.skipped')
 
-    for r in range(self.ROWS):
+
+  def scroll(self):
+    ''' step the long lines on, show them and come back when it is time '''
+    self.scroller = None
+    delay = SCROLL_SECS
+    for r, line in enumerate(self.lines):
+      if len(line) <= self.COLS:
+        # fits, stays put
+        continue
       if self.rdir[r] == 'L':
-        if self.rpos[r] + self.COLS < len(self.lines[r]):
-          self.rpos[r] += 1
-        else:
-          self.lastdisp = ticks + 10
+        self.rpos[r] = min(self.rpos[r] + 1, len(line) - self.COLS)
+        if self.rpos[r] + self.COLS >= len(line):
+          # the end is shown, stay a while, then back to the start
+          delay = SCROLL_PAUSE
           self.rdir[r] = 'R'
-      elif self.rdir[r] == 'R':
-        self.lastdisp = ticks + 10
+      else:
+        delay = SCROLL_PAUSE
         self.rdir[r] = 'L'
         self.rpos[r] = 0
+    self.display()
+    self._scrollafter(delay)
 
-    if 20 >= ticks - self.lastupd >= 0:
-      return
-    self.lastupd = ticks
 
-    self.update()
-    for r in range(self.ROWS):
-      if self.rpos[r] + self.COLS > len(self.lines[r]):
-        self.rdir[r] = 'L'
-        self.rpos[r] = 0
+  def rescroll(self):
+    ''' show the lines now, the long ones scroll on after a pause '''
+    if self.scroller:
+      self.scroller.cancel()
+      self.scroller = None
+    self.display()
+    self._scrollafter(SCROLL_PAUSE)
 
 
-  def tick(self):
-    self.display()
-    super(Playlist, self).tick()
+  def _scrollafter(self, delay):
+    if self.power != SLEEP and any(len(l) > self.COLS for l in self.lines):
+      self.scroller = self.loop.call_later(delay, self.scroll)
 
 
-  def run(self):
-    for cmd in ('clear', ['volume', '70'], ['load', self.text], 'play'):
-      self.mpccommand(cmd)
+  def marquee(self):
+    '''
+    The rows at their scroll positions
+
+    If the lcd keeps more of a line than it shows, a scrolling line is
+    put into display RAM once and the display shift is moved along with
+    it, so a step costs one shift command.  The shift moves all rows,
+    frame() rewrites whatever does not line up with it.  Lines longer
+    than the display RAM scroll in software.
+    '''
+    if not self.ddramcols:
+      return [self.msg2line(l[self.rpos[n]:]) for n,l in enumerate(self.lines)]
+
+    self.hshift = max([0] + [self.rpos[n] for n,l in enumerate(self.lines) if len(l) <= self.ddramcols])
+    return [
+      self.msg2line(l[self.rpos[n]:]) if len(l) > self.ddramcols or len(l) <= self.COLS else
+      l[self.rpos[n]:]
+      for n,l in enumerate(self.lines)
+    ]
+
+
+  def setpower(self, state):
+    asleep = self.power == SLEEP
+    super(Playlist, self).setpower(state)
+    if state == SLEEP and self.scroller:
+      self.scroller.cancel()
+      self.scroller = None
+    elif asleep:
+      if self.missed:
+        self.missed = False
+        self.update()
+      self.rescroll()
+
+
+  def start(self):
+    super(Playlist, self).start()
+    if not self.subscribed:
+      self.every(UPDATE_SECS, self.update)
+
+
+  def _started(self, results):
+    if results:
+      self._pushed(self._parse(*[mpdclient.todict(r) for r in results[-2:]]))
+    elif self.running:
+      self.update()
+
+
+  def tune(self, index=None):
+    '''
+    Play station index of the folder (the current one without), from
+    its position in the preloaded queue if there is one.  Until a tune
+    got to mpd the start volume goes with each (volumepending), after
+    play so that a mixer that refuses it does not keep the station
+    from starting.
+    '''
+    if index is not None:
+      items = self.parent.items
+      if not isinstance(items, Items):
+        return
+      self.index = index % len(items)
+      self.station = items.name(self.index)
+    pos = (self.parent.positions or {}).get(self.station)
+    if pos is None:
+      cmds = (('clear',), ('load', self.station), ('play',))
+    else:
+      cmds = (('play', pos),)
+    setvol = self.volumepending
+    if setvol:
+      cmds += (('setvol', str(self.volume)),)
+    self.parent.station = self.station
     self.play = True
+    self.lines = ['{%s}'%self.station] + [''] * (self.ROWS - 1)
     self.rpos = [0] * self.ROWS
     self.rdir = ['L'] * self.ROWS
-    self.lines = [''] * self.ROWS
-    self.lastdisp = 0
-    self.lastupd = 0
-    self.update()
-    super(Playlist, self).run()
+    if self.running:
+      self.rescroll()
+    # the stream may take a while to start, keep handling keys meanwhile
+    tuning = self.tuning = self.transport(cmds + (('status',), ('currentsong',)))
+    def started(results):
+      if setvol and results is not None:
+        self.volumepending = False
+      if pos is None:
+        # the preloaded queue is gone, now or when it comes
+        self.parent.positions = self.parent.queued = None
+      # not for a station tuned away from meanwhile
+      if tuning is self.tuning:
+        self._started(results)
+    self.loop.then(tuning, started)
+
+
+  def run(self):
+    super(Playlist, self).__init__(self.text, self.app)
+    self.volume = 70
+    self.volumer = self.noter = self.note = self.volumeset = None
+    self.volumepending = True
+    self.scroller = None
+    self.hshift = 0
+    self.missed = False
+    self.station = self.text
+    self.index = self.parent.items.index(self)
+    self.tuning = None
+    self.tune()
+    self.subscribed = bool(self.watcher) and self.watcher.subscribe(self._changed, ('player', 'mixer', 'playlist'))
+    self.app.playing = self
+    try:
+      super(Playlist, self).run()
+    finally:
+      self.app.playing = None
+      if self.subscribed:
+        self.watcher.unsubscribe(self._changed)
+      if self.hshift:
+        self.lcd.home()
+      if self.app.folder is self.parent:
+        # back on the station played last
+        self.app.goto(self.index)
 
 
 
@@ -468,12 +1186,17 @@ class Shutdown(Applet):
       ('Restart',  'Restarting...\n',    ['sudo', 'reboot']) if restart else \
       ('Shutdown', 'Shutting down...\n', ['sudo', 'poweroff'])
 
+  def msglist(self):
+    return [self.msg2line(l) for l in self._msg.split('\n')][:self.ROWS]
+
+  def _done(self, result):
+    if self.running:
+      raise FinishException
+
   def run(self):
     super(Shutdown, self).__init__(self.text, self.app)
-    self.lcd.home()
-    self.lcd.message(self._msg)
-    #sleep(1); self.left()
-    self.command(self._cmd)
+    self.loop.then(self.loop.run_in_executor('proc', self.command, self._cmd), self._done)
+    super(Shutdown, self).run()
 
 
 
@@ -482,13 +1205,21 @@ class Radio(App):
   The application.
   '''
 
-  def __init__(self, lcd=None, **kwargs):
+  def __init__(self, lcd=None, mpd=None, loop=None, **kwargs):
+    mpd = mpd or mpdclient.MPDClient()
+    loop = loop or eventloop.EventLoop()
+    self.playing = None
+    lcd = lcd or Locking_CharLCDPlate()
+    if hasattr(lcd, 'i2c'):
+      # the bundled driver, count its bus traffic
+      lcd.i2c.bus = metrics.MeteredBus(lcd.i2c.bus, loop.metrics)
+    self.playlists = Playlists(self)
     super(Radio, self).__init__(
-      lcd or Locking_CharLCDPlate(),
+      eventloop.Proxy(lcd, loop, 'i2c'),
       Folder(items=(
-        Playlists(self),
+        self.playlists,
         Folder(text='Settings', items=(
-          Node(call=lambda: (self.command(['hostname', '-I']) or ['NoIP'])[0]),
+          Later(self, loop, call=lambda: self.command(['hostname', '-I'])[0] or 'NoIP'),
           Timer(),
           Shutdown(self, triplet=('Fix WiFi', 'Fixing WiFi...\n', ('sudo', '/home/pi/bin/fixWiFi', 'logit'))),
           RGB(self),
@@ -501,9 +1232,14 @@ class Radio(App):
         #  Node(text='urk')
         #)),
       )),
+      mpd=mpd,
+      watcher=mpdclient.IdleWatcher(mpd.clone(timeout=None)),
+      loop=loop,
       **kwargs
     )
     self.mpccommand('clear')
+    self.watcher.subscribe(self.playlists._changed, ('stored_playlist',))
+    self.playlists.refresh()
 
 
   def up(self):
@@ -526,6 +1262,46 @@ class Radio(App):
       self.top = max(self.selected - self.ROWS + 1, 0)
 
 
+  def repeat(self, key, secs):
+    ''' held long enough, up/down jump to the previous/next initial '''
+    if secs < JUMP_SECS:
+      return super(Radio, self).repeat(key, secs)
+    self.jump(-1 if key == LCD.UP else 1)
+
+
+  def repeat_interval(self, secs):
+    if secs >= JUMP_SECS:
+      return JUMP_EVERY
+    return super(Radio, self).repeat_interval(secs)
+
+
+  def jump(self, step):
+    starts = self.folder.initials
+    if len(starts) < 2:
+      return
+    if step > 0:
+      k = bisect.bisect_right(starts, self.selected)
+      if k == len(starts) and not self.folder.wrap:
+        return
+    else:
+      k = bisect.bisect_left(starts, self.selected) - 1
+      if k < 0 and not self.folder.wrap:
+        return
+    self.goto(starts[k % len(starts)])
+
+
+  def goto(self, index):
+    ''' select item index, at the top of the display '''
+    count = len(self.folder.items)
+    self.selected = index
+    if count <= self.ROWS:
+      self.top = 0
+    elif self.folder.wrap:
+      self.top = index
+    else:
+      self.top = min(index, count - self.ROWS)
+
+
   def left(self):
     if not isinstance(self.folder.parent, Folder):
       return
@@ -545,8 +1321,7 @@ class Radio(App):
 
   def right(self):
     if isinstance(self.folder.items[self.selected], Applet):
-      self.folder.items[self.selected].run()
-      self.invalidatedisplay()
+      self.runapplet(self.folder.items[self.selected])
     elif isinstance(self.folder.items[self.selected], Folder):
       self.folder = self.folder.items[self.selected]
       self.top = self.selected = 0
@@ -558,8 +1333,7 @@ class Radio(App):
 
   def select(self):
     if isinstance(self.folder.items[self.selected], Applet):
-      self.folder.items[self.selected].run()
-      self.invalidatedisplay()
+      self.runapplet(self.folder.items[self.selected])
     else:
       # dummy into to update item text
       self.folder.items[self.selected].into()
@@ -571,42 +1345,80 @@ class Radio(App):
     def myexit(*args,**kwargs): raise SystemExit('sigterm')
     signal.signal(signal.SIGTERM, myexit)
 
+    # profile on request, see profiler.py
+    prof = profiler.Profiler(self.loop)
+    signal.signal(signal.SIGUSR1, lambda *args: prof.toggle(profiler.SAMPLE))
+    signal.signal(signal.SIGUSR2, lambda *args: prof.toggle(profiler.CPROFILE))
+    prof.fromenv()
+
+    self.watcher.start()
     try:
       super(Radio, self).run()
     except (KeyboardInterrupt, SystemExit):
       pass
+    prof.stop()
+    self.watcher.stop()
 
     # cleanup
     self.lcd.clear()
     self.lcd.message('Exited\n%s' % strftime(TIME_FORMAT)[-self.COLS:])
     self.lcd.set_backlight(0)
     self.mpccommand('clear')
+    self.playlists.restore()
+    self.loop.shutdown()
 
 
 
 
 if __name__ == '__main__':
 
+  import gpiochip
   import onlyone
   import sys
 
-  def myinit():
+  def myline():
+    ''' the plate's INT line as RADIO_INT says: [chip:]line, None to poll '''
+    spec = os.environ.get('RADIO_INT')
+    if not spec:
+      return None
+    chip, _, line = spec.rpartition(':')
+    try:
+      return gpiochip.LineEvent(int(line), chip or '/dev/gpiochip0')
+    except (ValueError, IOError, OSError) as e:
+      print "Error: %s\nRADIO_INT: %s, polling the buttons" % (str(e), spec)
+      return None
+
+  def myinit(interrupt):
     if not onlyone.me():
       onlyone.running()
-    # Initialize the LCD using my pins
-    lcd = Locking_CharLCDPlate(backlight=LCD.LCD_PLATE_SPARE, initial_color=(0,0,0))
+    # Initialize the LCD using my pins: the backlight on the spare pin,
+    # the RGB LED off
+    lcd = Locking_CharLCDPlate(backlight=LCD.LCD_PLATE_SPARE, initial_color=(0,0,0),
+      timing=os.environ.get('RADIO_LCD_TIMING', 'poll'), interrupt=interrupt)
     # my GREEN and BLUE are swapped
-    lcd._blue  = LCD.LCD_PLATE_GREEN
-    lcd._green = LCD.LCD_PLATE_BLUE
+    lcd.GREEN, lcd.BLUE = LCD.Adafruit_CharLCDPlate.BLUE, LCD.Adafruit_CharLCDPlate.GREEN
     return lcd
 
+  # the bus may not be up yet at boot, retry soon and then less often
+  interrupt = myline()
+  wait = 0.1
   while 'retry' in sys.argv:
     try:
-      lcd = myinit()
+      lcd = myinit(interrupt)
       break
     except IOError:
-      sleep(2)
+      sleep(wait)
+      wait = min(wait * 2, 5)
   else:
-      lcd = myinit()
-
-  Radio(lcd).run()
+      lcd = myinit(interrupt)
+
+  # something on the display before the rest starts
+  lcd.set_backlight(1)
+  lcd.message('Internet radio\nstarting...')
+  radio = Radio(lcd)
+  exporter = metrics.Exporter(radio.metrics)
+  exporter.start()
+  try:
+    radio.run()
+  finally:
+    exporter.stop()